@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""End-to-end HTTP benchmark of pywebdriver with fake devices.
+
+The Flask application is started in-process with stand-in backends:
+ * a pty pair for the customer display;
+ * the emulated serial port of the serial driver (virtual mode);
+ * a fake USB sink for the ESCPOS driver;
+ * a stub CUPS connection;
+ * a local python-opcua server.
+
+Each scenario is driven at a controlled concurrency, and throughput and
+latency percentiles are reported. Results are stored as json files so that
+two versions can be compared:
+
+    python benchmarks/http_bench.py -c 4 -n 500
+    python benchmarks/http_bench.py --compare benchmarks/results/0.4.17.json
+"""
+
+import argparse
+import array
+import base64
+import httplib
+import os
+import platform
+import pty
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tty
+import urllib2
+import urlparse
+from ConfigParser import ConfigParser
+
+import simplejson as json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_PATH = os.path.join(ROOT, 'benchmarks', 'results')
+OPCUA_ENDPOINT = 'opc.tcp://127.0.0.1:48410'
+
+sys.path.insert(0, ROOT)
+
+
+class PtyDevice(object):
+    """ Pseudo-terminal pair standing for a serial device.
+    The slave path is given to pywebdriver, the master side is drained
+    by a background thread."""
+
+    def __init__(self, name):
+        self.name = name
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.received = 0
+        thread = threading.Thread(target=self._drain)
+        thread.daemon = True
+        thread.start()
+
+    def _drain(self):
+        while True:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                time.sleep(0.01)
+                continue
+            self.received += len(data)
+
+
+class FakeUsbDevice(object):
+    """ Stand-in for the pyusb device used by the xmlescpos Usb class """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.written = 0
+        self.transfers = 0
+
+    def write(self, endpoint, data, interface=None, timeout=None):
+        with self.lock:
+            self.written += len(data)
+            self.transfers += 1
+        return len(data)
+
+    def read(self, endpoint, size, interface=None, timeout=None):
+        # DLE EOT answer: online, no error
+        return array.array('B', [0x12])
+
+    def is_kernel_driver_active(self, interface):
+        return False
+
+
+class StubCupsConnection(object):
+    """ Stand-in for cups.Connection """
+    job_id = 0
+
+    def printData(self, printer, data, title='Pywebdriver', options=None):
+        base64.b64decode(data)
+        StubCupsConnection.job_id += 1
+        return StubCupsConnection.job_id
+
+    def getPrinters(self):
+        return {'bench': {'printer-state': 3}}
+
+
+def start_opcua_server():
+    try:
+        from opcua import Server
+    except ImportError:
+        return None, None
+    server = Server()
+    server.set_endpoint(OPCUA_ENDPOINT)
+    idx = server.register_namespace('pywebdriver-benchmark')
+    node = server.get_objects_node().add_object(idx, 'Benchmark')
+    variable = node.add_variable(idx, 'Counter', 0)
+    variable.set_writable()
+    server.start()
+    return server, variable.nodeid.to_string()
+
+
+def write_config(display):
+    config = ConfigParser()
+    config.read(os.path.join(ROOT, 'config', 'config.ini'))
+    config.set('application', 'print_status_start', 'false')
+    config.set('display_driver', 'device_name', display.path)
+    # Only the pty of the emulator is accepted besides /dev/tty*. It reads
+    # the line faster than the requests write to it
+    config.set('serial_driver', 'mode', 'virtual')
+    config.set('serial_driver', 'baudrate', '115200')
+    # The requests are sent faster than printed: unbounded queue
+    config.set('escpos_driver', 'queue_size', '0')
+    # The same receipt is sent again and again: no deduplication
+    config.set('idempotency', 'ttl', '0')
+    fd, path = tempfile.mkstemp(prefix='pywebdriver-bench-', suffix='.ini')
+    with os.fdopen(fd, 'w') as f:
+        config.write(f)
+    return path
+
+
+def sample_receipt(lines=30):
+    orderlines = ''.join(
+        '<line><left>Produit n°%i à la crème</left>'
+        '<right><value>%i.50</value></right></line>' % (i, i)
+        for i in range(lines))
+    return (
+        u'<receipt align="center" width="40" value-thousands-separator="">'
+        u'<h1>PyWebDriver</h1><div>Benchmark receipt</div><br/>'
+        u'<div>%s</div><br/>'
+        u'<line size="double-height"><left>TOTAL</left>'
+        u'<right><value>1234.50</value></right></line>'
+        u'</receipt>' % orderlines.decode('utf-8'))
+
+
+def get_scenarios(devices, opcua_node):
+    receipt = sample_receipt()
+    cups_data = base64.b64encode('%PDF-1.4\n' + 'x' * 2048)
+    scenarios = [
+        ('print_xml_receipt', '/hw_proxy/print_xml_receipt',
+         lambda i: {'jsonrpc': '2.0', 'params': {'receipt': receipt}}),
+        ('print_xml_receipts', '/hw_proxy/print_xml_receipts',
+         lambda i: {'jsonrpc': '2.0',
+                    'params': {'receipts': [receipt] * 10}}),
+        ('status_json', '/hw_proxy/status_json',
+         lambda i: {'jsonrpc': '2.0', 'params': {}}),
+        ('serial_write', '/hw_proxy/serial_write',
+         lambda i: {'data': 'W%i' % i}),
+        ('send_text_customer_display',
+         '/hw_proxy/send_text_customer_display',
+         lambda i: {'jsonrpc': '2.0', 'params': {
+             'text_to_display': json.dumps(
+                 [u'Total', u'%i.00 EUR' % i])}}),
+        ('cups_print_data', '/cups/printData',
+         lambda i: {'args': ['bench', cups_data]}),
+    ]
+    if opcua_node:
+        scenarios.append(
+            ('opcua_write', '/hw_proxy/opcua_write',
+             lambda i: {'url': OPCUA_ENDPOINT,
+                        'commands': [[opcua_node, 'int64', i]]}))
+    return scenarios
+
+
+def percentile(values, rate):
+    if not values:
+        return None
+    index = int(round(rate / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def run_scenario(base_url, path, payload, requests, concurrency,
+                 keep_alive=False):
+    latencies = []
+    errors = [0]
+    counter = iter(xrange(requests))
+    lock = threading.Lock()
+
+    def worker():
+        # With keep_alive, each client sends its requests on one connection
+        connection = None
+        if keep_alive:
+            connection = httplib.HTTPConnection(
+                urlparse.urlparse(base_url).netloc, timeout=30)
+        while True:
+            with lock:
+                try:
+                    i = counter.next()
+                except StopIteration:
+                    break
+            body = json.dumps(payload(i))
+            start = time.time()
+            try:
+                if connection:
+                    connection.request(
+                        'POST', path, body,
+                        {'Content-Type': 'application/json'})
+                    response = connection.getresponse()
+                    data = response.read()
+                    ok = response.status == 200
+                else:
+                    response = urllib2.urlopen(urllib2.Request(
+                        base_url + path, body,
+                        {'Content-Type': 'application/json'}), timeout=30)
+                    data = response.read()
+                    ok = response.getcode() == 200
+                # JSON-RPC errors (driver busy...) are answered with 200
+                ok = ok and '"error"' not in data
+            except Exception:
+                ok = False
+                if connection:
+                    connection.close()
+            duration = time.time() - start
+            with lock:
+                latencies.append(duration)
+                if not ok:
+                    errors[0] += 1
+        if connection:
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors[0],
+        'elapsed': elapsed,
+        'throughput': requests / elapsed if elapsed else None,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p90': percentile(latencies, 90),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': latencies[-1] if latencies else None,
+    }
+
+
+def wait_queue_drained(driver, timeout=60):
+    start = time.time()
+    while driver.get_load() and time.time() - start < timeout:
+        time.sleep(0.01)
+    return time.time() - start
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.STDOUT).strip()
+    except Exception:
+        return None
+
+
+def compare(results, reference, threshold):
+    """ Print the deltas against a reference run and return the list of
+    the scenarios where a regression greater than threshold (%) occurs """
+    regressions = []
+    print '\n%-28s %12s %12s %12s' % (
+        'scenario', 'throughput', 'p50', 'p99')
+    for name, current in sorted(results['scenarios'].items()):
+        previous = reference['scenarios'].get(name)
+        if not previous:
+            continue
+        deltas = {}
+        for key in ('throughput', 'latency_p50', 'latency_p99'):
+            if previous[key]:
+                deltas[key] = (
+                    (current[key] - previous[key]) * 100.0 / previous[key])
+            else:
+                deltas[key] = 0.0
+        print '%-28s %+11.1f%% %+11.1f%% %+11.1f%%' % (
+            name, deltas['throughput'], deltas['latency_p50'],
+            deltas['latency_p99'])
+        if deltas['throughput'] < -threshold or \
+                deltas['latency_p99'] > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-c', '--concurrency', type=int, default=4,
+        help='Number of concurrent clients (default: 4)')
+    parser.add_argument(
+        '-n', '--requests', type=int, default=200,
+        help='Number of requests per scenario (default: 200)')
+    parser.add_argument(
+        '-s', '--scenario', action='append',
+        help='Only run this scenario (can be repeated)')
+    parser.add_argument(
+        '-o', '--output',
+        help='Result file (default: benchmarks/results/<version>-<date>.json)')
+    parser.add_argument(
+        '--compare', help='Compare the results with this result file')
+    parser.add_argument(
+        '--threshold', type=float, default=10.0,
+        help='Regression threshold in percent (default: 10)')
+    parser.add_argument(
+        '-k', '--keep-alive', action='store_true',
+        help='Send the requests of each client on a persistent connection')
+    args = parser.parse_args()
+
+    devices = {
+        'display': PtyDevice('display'),
+    }
+    os.environ['PYWEBDRIVER_CONFIG'] = write_config(devices['display'])
+
+    from werkzeug.serving import make_server
+    from pywebdriver.server import RequestHandler
+    from pywebdriver import app, drivers
+
+    class QuietRequestHandler(RequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    usb_device = FakeUsbDevice()
+    if 'escpos' in drivers:
+        printer = drivers['escpos'].add_printer('benchmark')
+        printer.device = usb_device
+        printer.get_printer_status = lambda: {
+            'printer': {'online': True, 'status_error': 0}}
+    if 'cups' in drivers:
+        drivers['cups'].getConnection = lambda: StubCupsConnection()
+    opcua_server, opcua_node = start_opcua_server()
+
+    server = make_server(
+        '127.0.0.1', 0, app, threaded=True,
+        request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:%i' % server.server_port
+
+    version = open(os.path.join(ROOT, 'VERSION')).read().strip()
+    results = {
+        'version': version,
+        'revision': git_revision(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'concurrency': args.concurrency,
+        'keep_alive': args.keep_alive,
+        'scenarios': {},
+    }
+
+    print '%-28s %10s %8s %10s %10s %10s' % (
+        'scenario', 'req/s', 'errors', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)')
+    try:
+        for name, path, payload in get_scenarios(devices, opcua_node):
+            if args.scenario and name not in args.scenario:
+                continue
+            result = run_scenario(
+                base_url, path, payload, args.requests, args.concurrency,
+                keep_alive=args.keep_alive)
+            if name.startswith('print_xml_receipt') and 'escpos' in drivers:
+                result['device_drain'] = wait_queue_drained(drivers['escpos'])
+                result['device_bytes'] = usb_device.written
+                result['device_transfers'] = usb_device.transfers
+            results['scenarios'][name] = result
+            print '%-28s %10.1f %8i %10.2f %10.2f %10.2f' % (
+                name, result['throughput'], result['errors'],
+                result['latency_p50'] * 1000, result['latency_p90'] * 1000,
+                result['latency_p99'] * 1000)
+    finally:
+        server.shutdown()
+        if opcua_server:
+            opcua_server.stop()
+        os.unlink(os.environ['PYWEBDRIVER_CONFIG'])
+
+    output = args.output or os.path.join(
+        RESULTS_PATH, '%s-%s.json' % (version, time.strftime('%Y%m%d-%H%M%S')))
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+    print '\nResults stored in %s' % output
+
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+        regressions = compare(results, reference, args.threshold)
+        if regressions:
+            print '\nPerformance regression on: %s' % ', '.join(regressions)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""Micro-benchmark of the JSON codecs on typical pywebdriver documents.
+
+The parse and serialize costs of the requests (xml receipt, Odoo 7
+receipt, customer display text) and of the answers (status, constant
+result) are measured with each installed codec, with the same options as
+pywebdriver.jsonrpc (which is not imported to keep the drivers stopped):
+
+    python benchmarks/json_bench.py -n 2000
+"""
+
+import argparse
+import timeit
+
+from http_bench import sample_receipt
+
+
+def get_codecs():
+    codecs = []
+    try:
+        import ujson
+        codecs.append(('ujson', ujson.loads, lambda obj: ujson.dumps(
+            obj, escape_forward_slashes=False)))
+    except ImportError:
+        pass
+    for name in ('simplejson', 'json'):
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+        codecs.append((name, module.loads, lambda obj, module=module: (
+            module.dumps(obj, separators=(',', ':')))))
+    return codecs
+
+
+def odoo7_receipt(lines=30):
+    return {
+        'name': 'Order 00042-001-0001',
+        'cashier': 'Administrator',
+        'date': {'year': 2014, 'month': 9, 'date': 12, 'day': 5,
+                 'hour': 10, 'minute': 42},
+        'company': {'name': 'Akretion', 'phone': '+33 4 00 00 00 00',
+                    'contact_address': 'Lyon', 'vat': 'FR00000000000'},
+        'orderlines': [{
+            'product_name': u'Produit n°%i à la crème' % i,
+            'quantity': 1.0, 'price': 1.5 + i, 'discount': 0,
+            'price_display': 1.5 + i, 'unit_name': 'Unit(s)',
+        } for i in range(lines)],
+        'paymentlines': [{'journal': 'Cash', 'amount': 500.0}],
+        'total_with_tax': 480.0, 'total_tax': 80.0, 'change': 20.0,
+        'currency': {'symbol': u'€', 'position': 'after', 'rounding': 0.01},
+    }
+
+
+def get_documents():
+    """ Return (name, document) of the requests and the answers """
+    statuses = dict((driver, {
+        'status': 'connected',
+        'messages': ['%s: ready' % driver],
+    }) for driver in ('escpos', 'display_driver', 'telium', 'cups'))
+    return [
+        ('print_xml_receipt', {'jsonrpc': '2.0', 'method': 'call', 'params': {
+            'receipt': sample_receipt()}}),
+        ('odoo7_receipt', {'jsonrpc': '2.0', 'method': 'call', 'params': {
+            'receipt': odoo7_receipt()}}),
+        ('send_text', {'jsonrpc': '2.0', 'method': 'call', 'params': {
+            'text_to_display': '["Produit a la creme", "TOTAL 12.50 EUR"]'}}),
+        ('status_json', {'jsonrpc': '2.0', 'result': statuses}),
+        ('result_true', {'jsonrpc': '2.0', 'result': True}),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-n', '--number', type=int, default=2000,
+        help='Number of runs of each measure (default: 2000)')
+    args = parser.parse_args()
+
+    codecs = get_codecs()
+    print '%-18s %-10s %8s %12s %10s' % (
+        'document', 'codec', 'size', 'loads (us)', 'dumps (us)')
+    for name, document in get_documents():
+        for codec, loads, dumps in codecs:
+            data = dumps(document)
+            if loads(data) != document:
+                print '%s: %s does not keep the document' % (name, codec)
+            loads_time = timeit.timeit(
+                lambda: loads(data), number=args.number)
+            dumps_time = timeit.timeit(
+                lambda: dumps(document), number=args.number)
+            print '%-18s %-10s %8i %12.2f %10.2f' % (
+                name, codec, len(data),
+                loads_time * 1e6 / args.number,
+                dumps_time * 1e6 / args.number)
+
+    # pywebdriver.jsonrpc answers the constant results with a prepared
+    # string: the remaining cost is the one of the string lookup
+    constant = codecs[0][2]({'jsonrpc': '2.0', 'result': True})
+    prepared_time = timeit.timeit(
+        lambda: constant if True is True else None, number=args.number)
+    print '%-18s %-10s %8i %12s %10.2f' % (
+        'result_true', 'prepared', len(constant), '-',
+        prepared_time * 1e6 / args.number)
+
+
+if __name__ == '__main__':
+    main()
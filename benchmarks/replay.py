@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""Replay of a device I/O capture against stand-in devices.
+
+A capture recorded with the [capture] file option is split in jobs (the
+I/O of a driver job, or of a request/answer exchange outside the jobs),
+and each captured device is driven by a ReplayDriver, a ThreadDriver
+queuing these jobs as the real driver does. The ESC/POS printers are
+replaced by the virtual USB printer, the other devices by a serial line
+sink. The jobs are pushed at their captured time, divided by --speed (0:
+all at once), and the throughput and latency percentiles of each device
+are reported and stored as json files, like http_bench.py:
+
+    python benchmarks/replay.py capture.bin --speed 2
+    python benchmarks/replay.py capture.bin --compare <result file>
+"""
+
+import argparse
+import os
+import platform
+import sys
+import tempfile
+import time
+from ConfigParser import ConfigParser
+
+import simplejson as json
+
+from http_bench import ROOT, RESULTS_PATH, compare, git_revision, percentile
+
+sys.path.insert(0, ROOT)
+
+# Delay (in seconds) splitting the I/O outside the jobs in several jobs
+IDLE_GAP = 0.5
+
+
+class SerialSink(object):
+    """ Stand-in of a serial device: the bytes cost their transmission
+    time at baudrate (10 bits per byte) """
+
+    def __init__(self, baudrate=9600):
+        self.baudrate = baudrate
+        self.written = 0
+
+    def write(self, endpoint, data, interface=None, timeout=None):
+        time.sleep(len(data) * 10.0 / self.baudrate)
+        self.written += len(data)
+        return len(data)
+
+    def read(self, endpoint, size, interface=None, timeout=None):
+        time.sleep(size * 10.0 / self.baudrate)
+
+
+def write_config(runtime=None):
+    config = ConfigParser()
+    config.read(os.path.join(ROOT, 'config', 'config.ini'))
+    config.set('application', 'print_status_start', 'false')
+    # The replay itself is not captured
+    if config.has_section('capture'):
+        config.remove_option('capture', 'file')
+    if runtime:
+        config.set('runtime', 'mode', runtime)
+    fd, path = tempfile.mkstemp(prefix='pywebdriver-replay-', suffix='.ini')
+    with os.fdopen(fd, 'w') as f:
+        config.write(f)
+    return path
+
+
+def read_jobs(path):
+    """ Return the jobs of a capture, in time order, as dicts with the
+    device, the task, the time and the (kind, delay, data) operations,
+    delay being the time since the previous operation of the job """
+    from pywebdriver.capture import read_capture
+    jobs = []
+    current = {}
+    for kind, timestamp, device, task, job_id, data in read_capture(path):
+        job = current.get(device)
+        if job is None or job['key'] != (task, job_id) or not job_id and (
+                timestamp - job['last'] > IDLE_GAP or
+                kind == 'W' and job['ops'][-1][0] == 'R'):
+            job = current[device] = {
+                'key': (task, job_id),
+                'device': device,
+                'task': task,
+                'time': timestamp,
+                'last': timestamp,
+                'ops': [],
+            }
+            jobs.append(job)
+        job['ops'].append((kind, timestamp - job['last'], data))
+        job['last'] = timestamp
+    return jobs
+
+
+def get_replay_driver_class():
+    from pywebdriver.plugins.base_driver import ThreadDriver
+
+    class ReplayDriver(ThreadDriver):
+        """ Replay the captured jobs of a device on a stand-in device """
+
+        event_source = 'replay'
+
+        def __init__(self, name, device, device_delays=False):
+            ThreadDriver.__init__(self)
+            self.device_key = name
+            self.device = device
+            self.device_delays = device_delays
+            self.latencies = []
+            self.bytes = 0
+
+        def estimate_size(self, task, data):
+            """ The bytes written by the captured job """
+            return sum(
+                len(chunk) for kind, delay, chunk in data['ops']
+                if kind == 'W')
+
+        def replay(self, job):
+            for kind, delay, data in job['ops']:
+                if kind == 'W':
+                    self.device.write(0x01, data)
+                    self.bytes += len(data)
+                else:
+                    # Time taken by the device to answer
+                    if self.device_delays:
+                        time.sleep(delay)
+                    self.device.read(0x82, len(data))
+            self.latencies.append(time.time() - job['pushed'])
+
+    return ReplayDriver
+
+
+def get_stand_in(device, args):
+    if device.startswith('escpos'):
+        from pywebdriver.plugins.virtual_device import VirtualUsbPrinter
+        return VirtualUsbPrinter(
+            usb_rate=args.usb_rate, buffer_size=args.buffer_size,
+            print_rate=args.print_rate)
+    return SerialSink(baudrate=args.baudrate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('capture', help='Capture file')
+    parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='Replay speed (default: 1, real time; 0: all the jobs at once)')
+    parser.add_argument(
+        '--device-delays', action='store_true',
+        help='Wait before each read as long as the captured device did')
+    parser.add_argument(
+        '--runtime', choices=('threads', 'shared'),
+        help='Runtime mode of the drivers (default: the one of config.ini)')
+    parser.add_argument(
+        '--baudrate', type=int, default=9600,
+        help='Baudrate of the serial devices (default: 9600)')
+    parser.add_argument(
+        '--usb-rate', type=int, default=1000000,
+        help='USB rate of the printers, in bytes/s (default: 1000000)')
+    parser.add_argument(
+        '--buffer-size', type=int, default=4096,
+        help='Receive buffer of the printers, in bytes (default: 4096)')
+    parser.add_argument(
+        '--print-rate', type=int, default=6000,
+        help='Printing speed of the printers, in bytes/s (default: 6000)')
+    parser.add_argument(
+        '-o', '--output',
+        help='Result file (default: '
+             'benchmarks/results/replay-<version>-<date>.json)')
+    parser.add_argument(
+        '--compare', help='Compare the results with this result file')
+    parser.add_argument(
+        '--threshold', type=float, default=10.0,
+        help='Regression threshold in percent (default: 10)')
+    args = parser.parse_args()
+
+    os.environ['PYWEBDRIVER_CONFIG'] = write_config(args.runtime)
+    try:
+        jobs = read_jobs(args.capture)
+        ReplayDriver = get_replay_driver_class()
+    finally:
+        os.unlink(os.environ['PYWEBDRIVER_CONFIG'])
+    if not jobs:
+        parser.error('%s: no I/O captured' % args.capture)
+
+    drivers = {}
+    for job in jobs:
+        if job['device'] not in drivers:
+            drivers[job['device']] = ReplayDriver(
+                job['device'], get_stand_in(job['device'], args),
+                device_delays=args.device_delays)
+
+    # The jobs are pushed at their captured offsets
+    origin = jobs[0]['time']
+    start = time.time()
+    for job in jobs:
+        if args.speed:
+            delay = start + (job['time'] - origin) / args.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        job['pushed'] = time.time()
+        drivers[job['device']].push_task('replay', job)
+    for driver in drivers.values():
+        while driver.get_load():
+            time.sleep(0.01)
+    duration = time.time() - start
+
+    version = open(os.path.join(ROOT, 'VERSION')).read().strip()
+    results = {
+        'version': version,
+        'revision': git_revision(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'capture': os.path.basename(args.capture),
+        'capture_duration': jobs[-1]['last'] - origin,
+        'speed': args.speed,
+        'duration': duration,
+        'scenarios': {},
+    }
+    print '%-28s %8s %10s %10s %10s %10s %10s' % (
+        'device', 'jobs', 'jobs/s', 'bytes', 'p50 (ms)', 'p90 (ms)',
+        'p99 (ms)')
+    for name, driver in sorted(drivers.items()):
+        latencies = sorted(driver.latencies)
+        result = {
+            'jobs': len(latencies),
+            'bytes': driver.bytes,
+            'throughput': len(latencies) / duration,
+            'latency_p50': percentile(latencies, 50),
+            'latency_p90': percentile(latencies, 90),
+            'latency_p99': percentile(latencies, 99),
+        }
+        results['scenarios'][name] = result
+        print '%-28s %8i %10.2f %10i %10.2f %10.2f %10.2f' % (
+            name, result['jobs'], result['throughput'], result['bytes'],
+            result['latency_p50'] * 1000, result['latency_p90'] * 1000,
+            result['latency_p99'] * 1000)
+    print '\nReplayed in %.2fs (captured in %.2fs)' % (
+        duration, results['capture_duration'])
+
+    output = args.output or os.path.join(RESULTS_PATH, 'replay-%s-%s.json' % (
+        version, time.strftime('%Y%m%d-%H%M%S')))
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+    print '\nResults stored in %s' % output
+
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+        regressions = compare(results, reference, args.threshold)
+        if regressions:
+            print '\nPerformance regression on: %s' % ', '.join(regressions)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -37,12 +37,15 @@ LOCAL_CONFIG_PATH = '%s/../config/config.ini' % os.path.dirname(
     os.path.realpath(__file__))
 PACKAGE_CONFIG_PATH = '/etc/pywebdriver/config.ini'
 
-config_file = PACKAGE_CONFIG_PATH
+# PYWEBDRIVER_CONFIG allows to run an instance with an alternate config
+# file (benchmarks, several instances on the same host, ...)
+config_file = os.environ.get('PYWEBDRIVER_CONFIG') or PACKAGE_CONFIG_PATH
 if not os.path.isfile(config_file):
     config_file = LOCAL_CONFIG_PATH
 assert os.path.isfile(config_file), (
     'Could not find config file (looking at %s and then %s )' % (
-        PACKAGE_CONFIG_PATH, LOCAL_CONFIG_PATH))
+        os.environ.get('PYWEBDRIVER_CONFIG') or PACKAGE_CONFIG_PATH,
+        LOCAL_CONFIG_PATH))
 config = ConfigParser()
 config.read(config_file)
 
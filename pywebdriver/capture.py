@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""Capture of the device I/O.
+
+When [capture] file is set, the bytes written to and read from the
+devices (ESC/POS printers, serial ports, customer display, payment
+terminal) are appended to this binary file, with their time, device, task
+and job. benchmarks/replay.py replays a capture against stand-in devices.
+
+The file starts with MAGIC, followed by records:
+ * 'N', id (uint16), length (uint16), utf-8 name: a device or task name;
+ * 'W' (written) or 'R' (read), time (double), device id (uint16), task
+   id (uint16), job id (uint32, 0 without job), length (uint32), bytes.
+All the numbers are little-endian.
+"""
+
+import array
+import struct
+import threading
+import time
+
+from flask import has_request_context, request
+
+from pywebdriver import app, config
+
+MAGIC = 'PWDCAP01'
+NAME = struct.Struct('<cHH')
+DATA = struct.Struct('<cdHHII')
+
+# Task of the current thread
+local = threading.local()
+
+
+def set_task(task, job_id=None):
+    local.task = task
+    local.job_id = job_id
+
+
+def get_task():
+    """ Return the task and the job id of the current thread: the driver
+    task, or else the endpoint of the request, or the thread name """
+    task = getattr(local, 'task', None)
+    if task is None:
+        if has_request_context() and request.endpoint:
+            return request.endpoint, 0
+        return threading.current_thread().name, 0
+    return task, getattr(local, 'job_id', None) or 0
+
+
+class Recorder(object):
+    """ Append the I/O records to a capture file. The file is flushed
+    every second at most """
+
+    flush_interval = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if not self.file.tell():
+            self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.names = {}
+        self.last_flush = time.time()
+
+    def _name_id(self, name):
+        name_id = self.names.get(name)
+        if name_id is None:
+            name_id = self.names[name] = len(self.names) + 1
+            data = name.encode('utf-8')
+            self.file.write(NAME.pack('N', name_id, len(data)) + data)
+        return name_id
+
+    def record(self, kind, device, data):
+        if not data:
+            return
+        if isinstance(data, array.array):
+            data = data.tostring()
+        elif isinstance(data, unicode):
+            data = data.encode('utf-8')
+        task, job_id = get_task()
+        now = time.time()
+        with self.lock:
+            header = DATA.pack(
+                kind, now, self._name_id(device), self._name_id(task),
+                job_id, len(data))
+            self.file.write(header + data)
+            if now - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = now
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(path):
+    """ Yield the (kind, time, device, task, job_id, data) records of a
+    capture file """
+    names = {}
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        while True:
+            kind = f.read(1)
+            if not kind:
+                return
+            if kind == 'N':
+                kind, name_id, size = NAME.unpack(kind + f.read(
+                    NAME.size - 1))
+                names[name_id] = f.read(size).decode('utf-8')
+                continue
+            kind, timestamp, device, task, job_id, size = DATA.unpack(
+                kind + f.read(DATA.size - 1))
+            yield (kind, timestamp, names[device], names[task], job_id,
+                   f.read(size))
+
+
+class CaptureDevice(object):
+    """ Device with the pyusb API (USB, virtual or network printer)
+    recording its I/O """
+
+    def __init__(self, device, name):
+        self.device = device
+        self.name = name
+
+    def write(self, endpoint, data, *args, **kwargs):
+        result = self.device.write(endpoint, data, *args, **kwargs)
+        recorder.record('W', self.name, data)
+        return result
+
+    def read(self, endpoint, size, *args, **kwargs):
+        data = self.device.read(endpoint, size, *args, **kwargs)
+        recorder.record('R', self.name, data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+
+def wrap_device(device, name):
+    """ Return the device, recording its I/O when the capture is on """
+    if recorder is None or not device:
+        return device
+    return CaptureDevice(device, name)
+
+
+def unwrap_device(device):
+    if isinstance(device, CaptureDevice):
+        return device.device
+    return device
+
+
+def serial_class(base, name):
+    """ Return a subclass of the pyserial class base recording the I/O of
+    the port as device name (base itself when the capture is off) """
+    if recorder is None:
+        return base
+
+    class CaptureSerial(base):
+
+        def write(self, data):
+            result = base.write(self, data)
+            recorder.record('W', name, data)
+            return result
+
+        def read(self, size=1):
+            data = base.read(self, size)
+            recorder.record('R', name, data)
+            return data
+
+    return CaptureSerial
+
+
+recorder = None
+if config.has_option('capture', 'file') and config.get('capture', 'file'):
+    recorder = Recorder(config.get('capture', 'file'))
+    app.logger.info('Device I/O captured in %s', recorder.path)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""Events of the drivers, pushed to the POS as server-sent events.
+
+The drivers publish their status changes, their finished jobs and the
+payment results on the bus; /hw_proxy/events streams them as they come.
+"""
+
+import itertools
+import time
+from collections import deque
+from threading import Condition, Thread
+
+from pywebdriver import config
+from pywebdriver import jsonrpc
+
+
+class EventBus(object):
+    """ Keep the last events and wake the subscribers up on each new one """
+
+    # Number of events kept for the subscribers reconnecting with
+    # Last-Event-ID
+    history = 200
+    # Delay (in seconds) between two keep-alive comments of the streams
+    heartbeat = 15
+
+    def __init__(self):
+        self.condition = Condition()
+        self.events = deque(maxlen=self.history)
+        self.counter = itertools.count(1)
+        self.last_id = 0
+        self.ticker = None
+
+    def publish(self, event, data):
+        with self.condition:
+            self.last_id = next(self.counter)
+            self.events.append((self.last_id, event, data))
+            self.condition.notify_all()
+
+    def _tick(self):
+        while True:
+            time.sleep(self.heartbeat)
+            with self.condition:
+                self.condition.notify_all()
+
+    def wait(self, last_id):
+        """ Return the events published after last_id. Without any, wait
+        for the next event or heartbeat (an empty list) """
+        with self.condition:
+            if self.ticker is None:
+                self.ticker = Thread(target=self._tick)
+                self.ticker.daemon = True
+                self.ticker.start()
+            # Waiting without timeout: the heartbeat wakes us up, and a
+            # publication is not delayed by the polling of Condition.wait
+            if self.last_id <= last_id:
+                self.condition.wait()
+            return [event for event in self.events if event[0] > last_id]
+
+    def can_resume(self, last_id):
+        """ True if all the events published after last_id are kept. The
+        ids of a previous run of the server are not known """
+        with self.condition:
+            oldest = self.events and self.events[0][0] or self.last_id + 1
+            return last_id is not None and \
+                oldest - 1 <= last_id <= self.last_id
+
+    def stream(self, last_id=None, initial=()):
+        """ Generate a text/event-stream: the initial (event, data) then
+        the events published after last_id (default: from now) """
+        if last_id is None or last_id > self.last_id:
+            last_id = self.last_id
+        for event, data in initial:
+            yield format_event(None, event, data)
+        while True:
+            events = self.wait(last_id)
+            if not events:
+                yield ': keep-alive\n\n'
+            for event_id, event, data in events:
+                last_id = event_id
+                yield format_event(event_id, event, data)
+
+
+def format_event(event_id, event, data):
+    message = 'event: %s\ndata: %s\n\n' % (event, jsonrpc.dumps(data))
+    if event_id is not None:
+        message = 'id: %i\n' % event_id + message
+    return message
+
+
+bus = EventBus()
+if config.has_option('flask', 'events_heartbeat'):
+    bus.heartbeat = config.getfloat('flask', 'events_heartbeat')
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""Deduplication of the retried requests.
+
+When the answer of a print or cash drawer request is lost, the POS sends
+the request again. The requests with the same idempotency key (the
+Idempotency-Key header or the idempotency_key param, or else the hash of
+the receipt) received during [idempotency] ttl seconds get the answer of
+the first one, without queuing a new job.
+"""
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import request
+
+from pywebdriver import app, config
+from pywebdriver import lanes
+from pywebdriver import tracing
+
+ttl = 30
+if config.has_option('idempotency', 'ttl'):
+    ttl = config.getfloat('idempotency', 'ttl')
+
+hash_receipts = False
+if config.has_option('idempotency', 'hash_receipts'):
+    hash_receipts = config.getboolean('idempotency', 'hash_receipts')
+
+
+class DedupCache(object):
+    """ Answers of the requests, by idempotency key, kept ttl seconds """
+
+    def __init__(self, ttl=30, size=1000):
+        self.ttl = ttl
+        self.size = size
+        # Key -> (expiration time, answer), in expiration order
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+
+    def _purge(self, now):
+        while self.entries:
+            key, (expires, answer) = next(self.entries.iteritems())
+            if expires > now and len(self.entries) <= self.size:
+                return
+            del self.entries[key]
+
+    def run(self, key, func, *args):
+        """ Return the answer of func(*args), or the one of the previous
+        call with the same key. The calls are serialized: the second of
+        two simultaneous requests gets the answer of the first one. An
+        exception is not kept, the request can be retried """
+        if not self.ttl or key is None:
+            return func(*args)
+        with self.lock:
+            now = time.time()
+            self._purge(now)
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                app.logger.info('Duplicate request %s ignored', key)
+                tracing.record('dedup', now, time.time(), key=key)
+                return entry[1]
+            answer = func(*args)
+            self.entries[key] = (now + self.ttl, answer)
+            return answer
+
+
+def get_key(name, params, data=None):
+    """ Return the idempotency key of a request named name, from its
+    header or params, or from the hash of data (with hash_receipts) """
+    lane = lanes.current()
+    if lane is not None:
+        name = '%s/%s' % (lane, name)
+    key = request.headers.get('Idempotency-Key') or \
+        params.get('idempotency_key')
+    if key:
+        return '%s:%s' % (name, key)
+    if data is None or not hash_receipts:
+        return None
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    elif not isinstance(data, str):
+        data = json.dumps(data, sort_keys=True)
+    return '%s#%s' % (name, hashlib.sha1(data).hexdigest())
+
+
+cache = DedupCache(ttl=ttl)
+
+
+def run(key, func, *args):
+    return cache.run(key, func, *args)
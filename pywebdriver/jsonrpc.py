@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""JSON layer of the HTTP API.
+
+Every route decodes its request and encodes its answer with this module.
+The codec is ujson when it is installed, then simplejson, then the json
+module of the standard library ([flask] json_codec forces one of them).
+"""
+
+from flask import Response, g, request
+from werkzeug.exceptions import BadRequest
+
+from pywebdriver import app, config
+from pywebdriver import tracing
+
+CODECS = ('ujson', 'simplejson', 'json')
+
+
+def load_codec(name):
+    """ Return the (loads, dumps) functions of a codec """
+    if name == 'ujson':
+        import ujson
+
+        def dumps(obj):
+            return ujson.dumps(obj, escape_forward_slashes=False)
+        return ujson.loads, dumps
+    if name == 'simplejson':
+        import simplejson as module
+    elif name == 'json':
+        import json as module
+    else:
+        raise ImportError('Unknown JSON codec %s' % name)
+
+    def dumps(obj):
+        return module.dumps(obj, separators=(',', ':'))
+    return module.loads, dumps
+
+
+codec_names = CODECS
+if config.has_option('flask', 'json_codec'):
+    codec_names = (config.get('flask', 'json_codec'), 'json')
+
+for codec_name in codec_names:
+    try:
+        loads, dumps = load_codec(codec_name)
+        break
+    except ImportError:
+        app.logger.info('JSON codec %s not available', codec_name)
+app.logger.debug('JSON codec: %s', codec_name)
+
+
+def get_payload(form_field=None):
+    """ Return the decoded JSON body of the request, None if there is no
+    JSON body. With form_field, the document can also be sent in this
+    form or query string field (Odoo 7). The result is cached for the
+    request. """
+    if 'jsonrpc_payload' not in g:
+        payload = None
+        try:
+            with tracing.span('parse'):
+                if request.is_json:
+                    data = request.get_data(cache=True)
+                    if data:
+                        payload = loads(data)
+                elif form_field and request.values.get(form_field):
+                    payload = loads(request.values[form_field])
+        except ValueError:
+            raise BadRequest('Invalid JSON document')
+        g.jsonrpc_payload = payload
+    return g.jsonrpc_payload
+
+
+def get_params(form_field=None):
+    """ Return the params of the JSON-RPC request ({} if missing) """
+    payload = get_payload(form_field=form_field)
+    if not payload:
+        return {}
+    if not isinstance(payload, dict):
+        raise InvalidParams('JSON object expected')
+    params = payload.get('params') or {}
+    if not isinstance(params, dict):
+        raise InvalidParams('params: JSON object expected')
+    return params
+
+
+def decode(value):
+    """ Decode a JSON document sent as a string inside the params """
+    if isinstance(value, basestring):
+        return loads(value)
+    return value
+
+
+def json_response(data, status=200):
+    return Response(dumps(data), status=status, mimetype='application/json')
+
+
+# The constant answers are serialized once
+RESULT_TRUE = dumps({'jsonrpc': '2.0', 'result': True})
+RESULT_FALSE = dumps({'jsonrpc': '2.0', 'result': False})
+RESULT_NONE = dumps({'jsonrpc': '2.0', 'result': None})
+
+
+def error_response(code, message, data=None):
+    """ Return a JSON-RPC error """
+    return Response(dumps({
+        'jsonrpc': '2.0',
+        'error': {'code': code, 'message': message, 'data': data},
+    }), mimetype='application/json')
+
+
+class InvalidParams(Exception):
+    """ The request has no JSON document, or not the expected one """
+
+
+@app.errorhandler(InvalidParams)
+def invalid_params(error):
+    return error_response(-32602, 'Invalid params', {'message': str(error)})
+
+
+def response(result=True, status=200):
+    """ Return the JSON-RPC answer of result """
+    if result is True:
+        body = RESULT_TRUE
+    elif result is False:
+        body = RESULT_FALSE
+    elif result is None:
+        body = RESULT_NONE
+    else:
+        body = dumps({'jsonrpc': '2.0', 'result': result})
+    return Response(body, status=status, mimetype='application/json')
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""Checkout lanes.
+
+By default an instance serves one POS with the drivers of `drivers`. Each
+[lane:NAME] section of the config declares another lane, with its own
+devices: the plugins build drivers (and driver threads) for it and
+register them in lanes[NAME]. A request is routed to a lane by the
+/lane/NAME prefix of its URL or by the lane param of its JSON-RPC params.
+The devices a lane does not declare are the ones of the default drivers.
+"""
+
+from collections import OrderedDict
+
+from flask import has_request_context, request
+
+from pywebdriver import app, config, drivers
+from pywebdriver import jsonrpc
+
+PREFIX = '/lane/'
+SECTION_PREFIX = 'lane:'
+
+# Lane name -> {driver name: driver}
+lanes = OrderedDict()
+
+
+class UnknownLane(Exception):
+    """ The request is routed to a lane missing from the config """
+
+    def __init__(self, lane):
+        Exception.__init__(self, 'Unknown lane %s' % lane)
+        self.lane = lane
+
+
+@app.errorhandler(UnknownLane)
+def unknown_lane(error):
+    return jsonrpc.error_response(-32002, 'Unknown lane', {
+        'lane': error.lane,
+        'lanes': lanes.keys(),
+        'message': str(error),
+    })
+
+
+def get_sections():
+    """ Return the (lane name, config section) of the declared lanes """
+    return [
+        (section[len(SECTION_PREFIX):], section)
+        for section in config.sections()
+        if section.startswith(SECTION_PREFIX)]
+
+
+for name, section in get_sections():
+    lanes[name] = {}
+
+
+def get_option(section, option, default=None):
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return default
+
+
+def register(lane, name, driver):
+    """ Register the driver `name` of a lane """
+    lanes[lane][name] = driver
+
+
+def current():
+    """ Return the lane of the current request, None for the default one """
+    if not has_request_context():
+        return None
+    lane = request.environ.get('pywebdriver.lane')
+    if lane is None and request.is_json:
+        # Any JSON document: only the lane of a params object is used
+        payload = jsonrpc.get_payload()
+        params = payload.get('params') if isinstance(payload, dict) else None
+        if isinstance(params, dict):
+            lane = params.get('lane')
+    if lane is not None and lane not in lanes:
+        raise UnknownLane(lane)
+    return lane
+
+
+def get_lane_option(option, default=None):
+    """ Return an option of the lane of the current request """
+    lane = current()
+    if lane is None:
+        return default
+    return get_option(SECTION_PREFIX + lane, option, default)
+
+
+def get_drivers():
+    """ Return the drivers of the lane of the current request, by name """
+    lane = current()
+    if lane is None:
+        return drivers
+    lane_drivers = OrderedDict(drivers)
+    lane_drivers.update(lanes[lane])
+    return lane_drivers
+
+
+def get_driver(name):
+    """ Return the driver `name` of the lane of the current request """
+    lane = current()
+    if lane is not None and name in lanes[lane]:
+        return lanes[lane][name]
+    return drivers[name]
+
+
+class LaneMiddleware(object):
+    """ Route the /lane/NAME/... requests to the application as /...,
+    with the lane in the environ """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith(PREFIX):
+            lane, sep, path = path[len(PREFIX):].partition('/')
+            environ['pywebdriver.lane'] = lane
+            environ['SCRIPT_NAME'] = '%s%s%s' % (
+                environ.get('SCRIPT_NAME', ''), PREFIX, lane)
+            environ['PATH_INFO'] = '/' + path
+        return self.wsgi_app(environ, start_response)
+
+
+app.wsgi_app = LaneMiddleware(app.wsgi_app)
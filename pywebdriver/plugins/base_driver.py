@@ -21,13 +21,52 @@
 #
 ###############################################################################
 
-from pywebdriver import app
-from threading import Thread, Lock
+from pywebdriver import app, config
+from pywebdriver import capture
+from pywebdriver import events
+from pywebdriver import jsonrpc
+from pywebdriver import profiling
+from pywebdriver import tracing
+from threading import Event, Thread, Lock, current_thread, local
 from Queue import Queue, Empty
-from flask import jsonify
+from collections import OrderedDict, deque
 import traceback
 import functools
+import itertools
 import time
+import weakref
+
+# Job ids are unique among all the drivers
+job_counter = itertools.count(1)
+
+QUEUE_POLICIES = ('reject', 'drop_oldest', 'coalesce')
+
+
+class DriverBusy(Exception):
+    """ The queue of the driver is full and the task can not be queued """
+
+    def __init__(self, driver, task, queue_size):
+        Exception.__init__(
+            self, 'The queue of %s is full (%i jobs)' % (driver, queue_size))
+        self.driver = driver
+        self.task = task
+        self.queue_size = queue_size
+
+
+class TaskAbandoned(Exception):
+    """ Raised in a worker abandoned by the watchdog when its task goes on
+    using the device, which now belongs to the new worker """
+
+
+@app.errorhandler(DriverBusy)
+def driver_busy(error):
+    return jsonrpc.error_response(-32001, 'Driver busy', {
+        'driver': error.driver,
+        'task': error.task,
+        'queue_size': error.queue_size,
+        'message': str(error),
+    })
+
 
 def check(installed, plugin):
     def wrap(func):
@@ -46,7 +85,7 @@ def check(installed, plugin):
                     % (plugin['name'],
                        plugin['require_pip'],
                        plugin['require_debian']))
-                return jsonify(jsonrpc='2.0', result=False)
+                return jsonrpc.response(False)
         return wrapped_func
     return wrap
 
@@ -57,54 +96,800 @@ class AbstractDriver(object):
         self.status = {'status':'disconnected', 'messages':[]}
 
 
-class ThreadDriver(Thread, AbstractDriver):
+class ThreadDriver(AbstractDriver):
+    """ Driver executing its tasks one by one in a worker thread """
+
+    # Number of finished jobs kept to answer the job status requests
+    job_history = 100
+    # Delay (in seconds) between two calls of refresh_status by the driver
+    # thread, between the jobs or when idle. None disables the refresh
+    status_interval = None
+    # Name of the driver in the events
+    event_source = None
+    # Number of distinct messages kept in the status
+    status_history = 10
+    # Throughput (in bytes/s) of the link to the device, giving the
+    # estimated duration of the jobs of a task until some are observed
+    link_rate = None
+    # Weight of the last job in the job duration model of its task
+    estimate_weight = 0.3
+    # Name of the device in the events, when a driver has several devices
+    device_key = None
+    # Maximum number of queued jobs (0: no limit), and what to do with a
+    # new job when the queue is full: 'reject' it (DriverBusy),
+    # 'drop_oldest' queued job of the same task, or 'coalesce' it with a
+    # queued job of the same task (even if the queue is not full)
+    queue_size = 0
+    queue_policy = 'reject'
+    # Policy of some tasks, overriding queue_policy
+    queue_policies = {}
+    # Maximum duration (in seconds) of a task (None: no limit). Beyond, the
+    # watchdog abandons the worker thread, resets the device and starts a
+    # new worker for the next jobs
+    task_timeout = None
+    # Timeout of some tasks, overriding task_timeout ('refresh_status' for
+    # the status refresh)
+    task_timeouts = {}
+    # False for the drivers whose tasks can block for long (a payment
+    # waiting for the card): with the shared runtime, they keep their own
+    # worker thread instead of holding a runner
+    shared_runtime = True
 
     def __init__(self, *args, **kwargs):
-        Thread.__init__(self)
         AbstractDriver.__init__(self, *args, **kwargs)
         self.queue = Queue()
         self.lock  = Lock()
         self.vendor_product = None
+        self.jobs = OrderedDict()
+        self.status_time = 0
+        self.worker = None
+        # Incremented for each new worker, an abandoned worker stops as
+        # soon as it sees it is not the current one
+        self.generation = 0
+        # Task executed by the worker, watched by the watchdog
+        self.current = None
+        # Generation of the worker running in the current thread
+        self.worker_local = local()
+        self.refresh_queued = False
+        # With the shared runtime: the driver is in the ready queue, or
+        # being executed by a runner
+        self.scheduled = False
+        # Task -> observed duration of its jobs: seconds per byte, and
+        # seconds per job for the jobs without data (moving averages)
+        self.job_models = {}
+        thread_drivers.add(self)
+
+    @classmethod
+    def configure(cls, section):
+        """ Read the queue, timeout and link_rate options from a section of
+        the config. queue_policy is the default policy and/or task:policy items,
+        for example: queue_policy=reject send_text:coalesce. task_timeout is
+        the default timeout and/or task:timeout items """
+        if config.has_option(section, 'task_timeout'):
+            cls.task_timeouts = dict(cls.task_timeouts)
+            for item in config.get(section, 'task_timeout').split():
+                task, sep, timeout = item.rpartition(':')
+                if task:
+                    cls.task_timeouts[task] = float(timeout)
+                else:
+                    cls.task_timeout = float(timeout)
+        if config.has_option(section, 'link_rate'):
+            cls.link_rate = config.getfloat(section, 'link_rate')
+        if config.has_option(section, 'queue_size'):
+            cls.queue_size = config.getint(section, 'queue_size')
+        if config.has_option(section, 'queue_policy'):
+            cls.queue_policies = dict(cls.queue_policies)
+            for item in config.get(section, 'queue_policy').split():
+                task, sep, policy = item.rpartition(':')
+                if policy not in QUEUE_POLICIES:
+                    raise ValueError(
+                        '%s: unknown queue policy %s' % (section, policy))
+                if task:
+                    cls.queue_policies[task] = policy
+                else:
+                    cls.queue_policy = policy
 
     def get_vendor_product(self):
         return self.vendor_product
 
     def lockedstart(self):
         with self.lock:
-            if not self.isAlive():
-                self.daemon = True
-                self.start()
+            if self.worker is None or not self.worker.is_alive():
+                self._start_worker()
+                started = True
+            else:
+                started = False
+        watchdog.start()
+        if started and self.uses_runtime():
+            # First status refresh
+            runtime.schedule(self)
+
+    def uses_runtime(self):
+        """ True if the jobs are executed by the runners of the shared
+        runtime """
+        return runtime.shared and self.shared_runtime
+
+    def _start_worker(self):
+        self.generation += 1
+        if self.uses_runtime():
+            self.worker = runtime
+            return
+        self.worker = Thread(
+            target=self.run, args=(self.generation,),
+            name='%s-%i' % (
+                self.device_key or self.event_source or
+                self.__class__.__name__, self.generation))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def get_task_timeout(self, task, job_id=None):
+        return self.task_timeouts.get(task, self.task_timeout)
+
+    def _begin(self, generation, task, job_id=None):
+        capture.set_task(task, job_id)
+        self.worker_local.generation = generation
+        with self.lock:
+            self.current = {
+                'task': task,
+                'job_id': job_id,
+                'started': time.time(),
+                'timeout': self.get_task_timeout(task, job_id),
+            }
+
+    def check_abandoned(self):
+        """ Raise TaskAbandoned if the current thread runs a worker
+        abandoned by the watchdog. Called before each access to the device
+        by the drivers whose tasks can be long """
+        generation = getattr(self.worker_local, 'generation', None)
+        if generation is not None and generation != self.generation:
+            raise TaskAbandoned(
+                '%s: task of an abandoned worker stopped' % (
+                    self.device_key or self.event_source or
+                    self.__class__.__name__))
+
+    def _end(self, generation):
+        """ Return False if the worker has been abandoned meanwhile """
+        capture.set_task(None)
+        with self.lock:
+            if generation != self.generation:
+                return False
+            self.current = None
+            return True
+
+    def check_timeout(self, now):
+        """ Called by the watchdog: abandon the worker if its task lasts
+        longer than its timeout, and start a new one """
+        with self.lock:
+            current = self.current
+            if not current or not current['timeout'] or \
+                    now - current['started'] < current['timeout']:
+                return
+            self.current = None
+            # Abandon the worker, the new one starts once the device reset
+            self.generation += 1
+        message = 'Task %s timed out after %is, device reset' % (
+            current['task'], current['timeout'])
+        app.logger.error('%s: %s', self.device_key or self.event_source or
+                         self.__class__.__name__, message)
+        if current['job_id'] is not None:
+            self.queue.task_done()
+            self._update_job(current['job_id'], state='error', result=message)
+        self.set_status('error', message)
+        try:
+            self.reset_device()
+        except Exception as e:
+            app.logger.error('Unable to reset the device: %s', e)
+        with self.lock:
+            self._start_worker()
+        if self.uses_runtime():
+            # The runner executing the hung task is replaced, and the
+            # driver is scheduled again for its next jobs
+            runtime.replace_runner()
+            with self.lock:
+                self.scheduled = False
+            runtime.schedule(self)
+
+    def reset_device(self):
+        """ Release the device used by a hung task, so that the new worker
+        opens it again """
+
+    def request_refresh(self, now):
+        """ Called by the watchdog: wake an idle worker up when its status
+        has to be refreshed """
+        if self.status_interval and not self.refresh_queued and \
+                not self.queue.unfinished_tasks and \
+                now - self.status_time >= self.status_interval and \
+                self.worker is not None:
+            self.refresh_queued = True
+            self.queue.put((now, None, None, None, None))
+            runtime.schedule(self)
+
+    def _status_snapshot(self):
+        return {
+            'status': self.status['status'],
+            'messages': list(self.status['messages']),
+        }
+
+    def _publish_status(self, previous):
+        # Only the changes of state are published, the messages can change
+        # at each refresh (counters, ...)
+        status = self._status_snapshot()
+        if status['status'] != previous['status']:
+            events.bus.publish('status', {
+                'driver': self.event_source,
+                'device': self.device_key,
+                'status': status,
+            })
 
     def set_status(self, status, message = None):
-        if status == self.status['status']:
-            if message != None and (
-                    len(self.status['messages']) == 0 \
-                    or message != self.status['messages'][-1]):
-                self.status['messages'].append(message)
+        previous = self._status_snapshot()
+        self._set_status(status, message)
+        self._publish_status(previous)
+
+    def _set_status(self, status, message = None):
+        """ Set the status. The distinct messages received since the status
+        changed are kept in message_history (status_history at most, the
+        most recent last) with their count and first and last times, and
+        listed in messages. self.status is replaced, never changed in
+        place: the other threads read it without lock """
+        now = time.time()
+        changed = status != self.status['status']
+        if changed:
+            history = []
+        elif self.status.get('message_history') is None:
+            # Status set without set_status
+            history = [
+                {'message': text, 'count': 1, 'first_seen': now,
+                 'last_seen': now}
+                for text in self.status['messages']]
         else:
-            self.status['status'] = status
-            if message:
-                self.status['messages'] = [message]
+            history = list(self.status['message_history'])
+        # An empty message is only kept while the status does not change
+        if message is not None and (message or not changed):
+            for index, item in enumerate(history):
+                if item['message'] == message:
+                    del history[index]
+                    item = dict(
+                        item, count=item['count'] + 1, last_seen=now)
+                    break
             else:
-                self.status['messages'] = []
+                item = {'message': message, 'count': 1, 'first_seen': now,
+                        'last_seen': now}
+            history.append(item)
+            del history[:-self.status_history]
+        self.status = {
+            'status': status,
+            'messages': [entry['message'] for entry in history],
+            'message_history': history,
+        }
 
     def process_task(self, task, timestamp, data):
         return getattr(self, task)(data)
 
     def push_task(self, task, data = None):
+        """ Queue the task and return the id of the job. The trace of the
+        current request is queued with the task """
         if not hasattr(self, task):
             raise AttributeError(
                 'The method %s do not exist for the Driver' % task)
+        with tracing.span('enqueue', task=task, driver=self.event_source,
+                          device=self.device_key):
+            return self._push_task(task, data)
+
+    def _push_task(self, task, data):
+        self.lockedstart()
+        policy = self.queue_policies.get(task, self.queue_policy)
+        dropped = None
+        try:
+            size = self.estimate_size(task, data)
+        except Exception as e:
+            # The estimate never prevents a job from being queued
+            app.logger.warning(
+                'Unable to estimate the size of a %s job: %s', task, e)
+            size = 0
+        with self.lock:
+            if policy == 'coalesce':
+                job_id = self._coalesce(task, data)
+                if job_id:
+                    self.jobs[job_id].update(
+                        size=size, estimate=self.estimate_duration(task, size))
+                    return job_id
+            if self.queue_size and self.count_queued() >= self.queue_size:
+                if policy == 'drop_oldest':
+                    dropped = self._remove_queued(task)
+                if not dropped:
+                    raise DriverBusy(
+                        self.device_key or self.event_source or
+                        self.__class__.__name__, task, self.queue_size)
+            job_id = next(job_counter)
+            self.jobs[job_id] = {
+                'job_id': job_id,
+                'task': task,
+                'state': 'queued',
+                'result': None,
+                'size': size,
+                'estimate': self.estimate_duration(task, size),
+            }
+            while len(self.jobs) > self.job_history:
+                self.jobs.popitem(last=False)
+            trace = tracing.current()
+            if trace is not None:
+                trace.hold()
+            self.queue.put((time.time(), task, data, job_id, trace))
+        runtime.schedule(self)
+        if dropped:
+            self._update_job(dropped[3], state='dropped')
+            if dropped[4] is not None:
+                dropped[4].release()
+        return job_id
+
+    def _coalesce(self, task, data):
+        """ Replace the data of the last queued job of the task, and return
+        its id (None if there is no such job) """
+        with self.queue.mutex:
+            items = self.queue.queue
+            for index in reversed(range(len(items))):
+                item = items[index]
+                if item[1] == task:
+                    items[index] = item[:2] + (data,) + item[3:]
+                    return item[3]
+        return None
+
+    def _remove_queued(self, task):
+        """ Remove the oldest queued job of the task and return it """
+        with self.queue.mutex:
+            items = self.queue.queue
+            for index, item in enumerate(items):
+                if item[1] == task:
+                    del items[index]
+                    self.queue.unfinished_tasks -= 1
+                    if not self.queue.unfinished_tasks:
+                        self.queue.all_tasks_done.notify_all()
+                    return item
+        return None
+
+    def get_job(self, job_id):
+        """ Return the job, with the estimated time (in seconds) until it
+        is finished (eta) while it is queued or running """
+        job = self.jobs.get(job_id)
+        if job and job['state'] in ('queued', 'running'):
+            drain_time, etas = self.get_queue_estimate()
+            job = dict(job, eta=etas.get(job_id, 0.0))
+        return job
+
+    def estimate_size(self, task, data):
+        """ Size (in bytes) of the data a job sends to the device: the
+        length of a string, the sum of the items of a list, 0 otherwise """
+        if isinstance(data, basestring):
+            return len(data)
+        if isinstance(data, (list, tuple)):
+            return sum(self.estimate_size(task, item) for item in data)
+        return 0
+
+    def estimate_duration(self, task, size):
+        """ Estimated duration (in seconds) of a job of the task sending
+        size bytes: from the durations of the previous jobs of the task,
+        or else from the link rate """
+        model = self.job_models.get(task)
+        if model:
+            if size and model['byte_time'] is not None:
+                return size * model['byte_time']
+            return model['job_time']
+        if size and self.link_rate:
+            return size / float(self.link_rate)
+        return 0.0
+
+    def _observe_job(self, task, job_id, duration):
+        """ Update the duration model of the task with a finished job """
+        job = self.jobs.get(job_id)
+        if not job:
+            return
+        size = job.get('size')
+        byte_time = size and duration / size or None
+        model = self.job_models.get(task)
+        if model is None:
+            self.job_models[task] = {
+                'job_time': duration, 'byte_time': byte_time}
+            return
+        weight = self.estimate_weight
+        model['job_time'] += weight * (duration - model['job_time'])
+        if byte_time is not None:
+            if model['byte_time'] is None:
+                model['byte_time'] = byte_time
+            else:
+                model['byte_time'] += weight * (
+                    byte_time - model['byte_time'])
+
+    def get_queue_estimate(self):
+        """ Return the estimated time (in seconds) to finish the running
+        and queued jobs, and the one of each job by id """
+        now = time.time()
+        drain_time = 0.0
+        etas = {}
+        with self.lock:
+            current = self.current
+            if current and current['job_id'] in self.jobs:
+                job = self.jobs[current['job_id']]
+                drain_time = max(
+                    0.0, job['estimate'] - (now - current['started']))
+                etas[job['job_id']] = drain_time
+            with self.queue.mutex:
+                items = list(self.queue.queue)
+            for item in items:
+                job = self.jobs.get(item[3])
+                if item[1] is None or not job:
+                    continue
+                drain_time += job['estimate']
+                etas[item[3]] = drain_time
+        return drain_time, etas
+
+    def get_queue_status(self):
+        """ Queue part of the status: number of jobs, estimated time (in
+        seconds) to drain the queue and to finish each job """
+        drain_time, etas = self.get_queue_estimate()
+        return {
+            'jobs': self.get_load(),
+            'eta': round(drain_time, 3),
+            'job_etas': [
+                {'job_id': job_id, 'eta': round(eta, 3)}
+                for job_id, eta in sorted(etas.items())],
+        }
+
+    def count_queued(self):
+        """ Number of jobs waiting in the queue, without the status
+        refreshes """
+        with self.queue.mutex:
+            return sum(1 for item in self.queue.queue if item[1] is not None)
+
+    def get_load(self):
+        """ Number of jobs queued or running """
+        return self.queue.unfinished_tasks
+
+    def take_pending(self):
+        """ Remove the queued jobs from the driver and return them as
+        (item, job) tuples, to be given to another driver with requeue() """
+        pending = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                return pending
+            self.queue.task_done()
+            if item[1] is None:
+                self.refresh_queued = False
+                continue
+            with self.lock:
+                job = self.jobs.pop(item[3], None)
+            pending.append((item, job))
+
+    def requeue(self, item, job=None):
+        """ Queue a job taken from another driver """
         self.lockedstart()
-        self.queue.put((time.time(), task, data))
+        if job:
+            with self.lock:
+                self.jobs[job['job_id']] = job
+        self.queue.put(item)
+        runtime.schedule(self)
+
+    def _update_job(self, job_id, **values):
+        job = self.jobs.get(job_id)
+        if job:
+            job.update(values)
+            if job['state'] in ('done', 'error', 'dropped'):
+                events.bus.publish('job', dict(
+                    job, driver=self.event_source, device=self.device_key))
+
+    def refresh_status(self):
+        """ Read the status from the device and publish it in self.status.
+        Only called by the driver thread, that owns the device I/O """
+
+    def _refresh_status(self, generation):
+        previous = self._status_snapshot()
+        self._begin(generation, 'refresh_status')
+        try:
+            self.refresh_status()
+        except TaskAbandoned as e:
+            app.logger.warning('%s', e)
+        except Exception as e:
+            self._set_status('error', str(e))
+            app.logger.error('Unable to refresh the status: %s', e)
+        if not self._end(generation):
+            return
+        self.status_time = time.time()
+        self._publish_status(previous)
+
+    def run(self, generation):
+        # The worker waits for the jobs without timeout (a timed wait polls
+        # the queue every 50ms at most), the watchdog queues an empty item
+        # when the status has to be refreshed
+        while generation == self.generation:
+            if self.status_interval and \
+                    time.time() - self.status_time >= self.status_interval:
+                self._refresh_status(generation)
+                continue
+            self._process_item(self.queue.get(), generation)
+
+    def run_once(self):
+        """ Shared runtime: refresh the status if needed, or execute the
+        next queued job. Return the generation of the execution """
+        generation = self.generation
+        if self.status_interval and \
+                time.time() - self.status_time >= self.status_interval:
+            self._refresh_status(generation)
+            return generation
+        try:
+            item = self.queue.get_nowait()
+        except Empty:
+            return generation
+        self._process_item(item, generation)
+        return generation
+
+    def _process_item(self, item, generation):
+        timestamp, task, data, job_id, trace = item
+        if task is None:
+            self.refresh_queued = False
+            self.queue.task_done()
+            return
+        self._begin(generation, task, job_id)
+        if trace is not None:
+            tracing.activate(trace)
+            tracing.record(
+                'queue_wait', timestamp, time.time(),
+                driver=self.event_source, device=self.device_key)
+        try:
+            self._update_job(job_id, state='running')
+            started = time.time()
+            with tracing.span('task', task=task, job_id=job_id):
+                if profiling.active:
+                    result = profiling.run(
+                        'task', self.process_task, task, timestamp, data)
+                else:
+                    result = self.process_task(task, timestamp, data)
+            if generation == self.generation:
+                self._observe_job(task, job_id, time.time() - started)
+                self._update_job(job_id, state='done', result=result)
+        except TaskAbandoned as e:
+            app.logger.warning('%s', e)
+        except Exception as e:
+            if generation == self.generation:
+                self._update_job(job_id, state='error', result=str(e))
+                self.set_status('error', str(e))
+            errmsg = str(e) + '\n' + '-'*60+'\n' + traceback.format_exc()\
+                     + '-'*60 + '\n'
+            app.logger.error(errmsg)
+        finally:
+            # The job of an abandoned worker is already accounted
+            if self._end(generation):
+                self.queue.task_done()
+            if trace is not None:
+                tracing.deactivate()
+                trace.release()
+
+
+class Watchdog(object):
+    """ Check every interval seconds that no driver task lasts longer than
+    its timeout, and wake the idle drivers up for their status refresh """
+
+    interval = 1
+
+    def __init__(self):
+        self.lock = Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name='watchdog')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            for driver in list(thread_drivers):
+                try:
+                    driver.check_timeout(now)
+                    driver.request_refresh(now)
+                except Exception as e:
+                    app.logger.error('Watchdog: %s', e)
+
+
+class DriverRuntime(object):
+    """ Execution of the thread drivers. By default each driver has its
+    own worker thread. When shared, the queue of each driver is a mailbox
+    served by a small pool of runner threads: a driver with queued jobs is
+    put in the ready queue, and a runner executes its next job (or status
+    refresh) before putting it back at the end of the ready queue if it
+    has other jobs. The jobs of a driver are still executed one at a time
+    and in order, and the drivers share the runners fairly. The drivers
+    whose tasks can block for long keep their own worker thread. """
+
+    def __init__(self, shared=False, runners=2):
+        self.shared = shared
+        self.runners = runners
+        self.ready = Queue()
+        self.lock = Lock()
+        self.threads = []
+        self.counter = itertools.count(1)
+
+    def is_alive(self):
+        """ Used as the worker of the drivers, always running """
+        return True
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.runners:
+                self._start_runner()
+
+    def _start_runner(self):
+        thread = Thread(
+            target=self.run, name='runner-%i' % next(self.counter))
+        thread.daemon = True
+        self.threads.append(thread)
+        thread.start()
+
+    def replace_runner(self):
+        """ Start a new runner instead of the one hung in a task, which
+        stops if its task ever ends """
+        with self.lock:
+            self._start_runner()
+
+    def schedule(self, driver):
+        """ Put the driver in the ready queue, unless it is already """
+        if not driver.uses_runtime():
+            return
+        with driver.lock:
+            if driver.scheduled:
+                return
+            driver.scheduled = True
+        self.start()
+        self.ready.put(driver)
 
     def run(self):
         while True:
+            driver = self.ready.get()
             try:
-                timestamp, task, data = self.queue.get(True)
-                self.process_task(task, timestamp, data)
+                generation = driver.run_once()
             except Exception as e:
-                self.set_status('error', str(e))
-                errmsg = str(e) + '\n' + '-'*60+'\n' + traceback.format_exc()\
-                         + '-'*60 + '\n'
-                app.logger.error(errmsg)
+                app.logger.error('Runner: %s', e)
+                generation = driver.generation
+            with driver.lock:
+                abandoned = generation != driver.generation
+                if not abandoned:
+                    if driver.queue.qsize():
+                        self.ready.put(driver)
+                    else:
+                        driver.scheduled = False
+            if abandoned:
+                # The watchdog has replaced this runner and scheduled the
+                # driver again
+                with self.lock:
+                    self.threads.remove(current_thread())
+                return
+
+
+class Call(object):
+    """ Call submitted to the executor """
+
+    def __init__(self, key, func, args, kwargs):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.done = Event()
+        self.value = None
+        self.error = None
+        self.trace = tracing.current()
+        if self.trace is not None:
+            self.trace.hold()
+        # Task of the submitter (its endpoint), for the device I/O capture
+        self.task = capture.get_task() if capture.recorder else None
+
+    def run(self):
+        if self.trace is not None:
+            tracing.activate(self.trace)
+        if self.task is not None:
+            capture.set_task(*self.task)
+        try:
+            with tracing.span('call', key=self.key):
+                if profiling.active:
+                    self.value = profiling.run(
+                        'task', self.func, *self.args, **self.kwargs)
+                else:
+                    self.value = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.trace is not None:
+                tracing.deactivate()
+                self.trace.release()
+            if self.task is not None:
+                capture.set_task(None)
+            self.done.set()
+
+    def result(self):
+        """ Wait for the end of the call and return its result (a timed
+        wait would poll the event every 50ms at most) """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Executor(object):
+    """ Small pool of threads executing the calls of the blocking
+    libraries (serial ports, OPC UA, CUPS, MTP) for the HTTP requests. The
+    calls with the same key (a device) are executed one at a time, in
+    order: two requests can not use a device at the same time, and the
+    number of threads blocked on devices is bounded. Without threads, the
+    calls are executed by the HTTP threads. """
+
+    def __init__(self, threads=4):
+        self.threads = threads
+        self.queue = Queue()
+        self.lock = Lock()
+        self.started = False
+        # Key -> calls waiting for the running call with the same key
+        self.pending = {}
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        for index in range(self.threads):
+            thread = Thread(target=self.run, name='executor-%i' % (index + 1))
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, key, func, *args, **kwargs):
+        """ Queue the call and return it """
+        self.start()
+        call = Call(key, func, args, kwargs)
+        with self.lock:
+            if key in self.pending:
+                self.pending[key].append(call)
+                return call
+            self.pending[key] = deque()
+        self.queue.put(call)
+        return call
+
+    def call(self, key, func, *args, **kwargs):
+        """ Execute the call in the executor and return its result """
+        if not self.threads:
+            return func(*args, **kwargs)
+        return self.submit(key, func, *args, **kwargs).result()
+
+    def run(self):
+        while True:
+            call = self.queue.get()
+            call.run()
+            with self.lock:
+                pending = self.pending[call.key]
+                if pending:
+                    self.queue.put(pending.popleft())
+                else:
+                    del self.pending[call.key]
+
+
+# The thread drivers watched by the watchdog
+thread_drivers = weakref.WeakSet()
+watchdog = Watchdog()
+
+runtime_mode = 'threads'
+if config.has_option('runtime', 'mode'):
+    runtime_mode = config.get('runtime', 'mode')
+if runtime_mode not in ('threads', 'shared'):
+    raise ValueError('runtime: unknown mode %s' % runtime_mode)
+runners = 2
+if config.has_option('runtime', 'runners'):
+    runners = config.getint('runtime', 'runners')
+runtime = DriverRuntime(shared=runtime_mode == 'shared', runners=runners)
+
+# Handing the calls over to other threads costs about 1ms with the GIL,
+# the executor is only used by default with the shared runtime
+executor_threads = 4 if runtime.shared else 0
+if config.has_option('runtime', 'executor_threads'):
+    executor_threads = config.getint('runtime', 'executor_threads')
+executor = Executor(threads=executor_threads)
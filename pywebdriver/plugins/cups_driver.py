@@ -24,10 +24,11 @@ import cups
 import tempfile
 
 from flask_cors import cross_origin
-from flask import request, jsonify, make_response
+from flask import request
 
 from pywebdriver import app, drivers
-from .base_driver import AbstractDriver
+from pywebdriver import jsonrpc
+from .base_driver import AbstractDriver, executor
 import logging
 _logger = logging.getLogger(__name__)
 
@@ -99,23 +100,23 @@ class CupsDriver(AbstractDriver):
 def cupsapi():
     args = []
     kwargs = {}
-    if request.json:
-        args = request.json.get('args', [])
-        kwargs = request.json.get('kwargs', {})
+    payload = jsonrpc.get_payload()
+    if payload:
+        args = payload.get('args', [])
+        kwargs = payload.get('kwargs', {})
     if request.args:
         kwargs = request.args.to_dict()
     conn = drivers['cups'].getConnection()
     try:
-        result = conn.printData(*args, **kwargs)
+        result = executor.call('cups', conn.printData, *args, **kwargs)
     # TODO we should implement all cups error
     except cups.IPPError as (status, description):
-        return make_response(
-            jsonify({
+        return jsonrpc.json_response({
                 'cups_error': 'IPPError',
                 'cups_error_status': status,
                 'cups_error_description': description,
-                }), 400)
+                }, 400)
 
-    return jsonify(jsonrpc='2.0', result=result)
+    return jsonrpc.response(result)
 
 drivers['cups'] = CupsDriver()
@@ -20,10 +20,14 @@
 ###############################################################################
 
 from pywebdriver import app, config, drivers
+from pywebdriver import capture
+from pywebdriver import jsonrpc
+from pywebdriver import lanes
 from flask_cors import cross_origin
-from flask import request, jsonify, render_template
+from flask import render_template
 from base_driver import ThreadDriver, check
-import simplejson
+from virtual_device import VirtualDisplay, is_virtual
+import sys
 import time
 
 meta = {
@@ -51,6 +55,10 @@ else:
     class DisplayDriver(ThreadDriver, pyposdisplay.Driver):
         """ Display Driver class for pywebdriver """
 
+        event_source = 'display_driver'
+        # Only the last text matters
+        queue_policies = {'send_text': 'coalesce'}
+
         def __init__(self, *args, **kwargs):
             ThreadDriver.__init__(self)
             pyposdisplay.Driver.__init__(self, *args, **kwargs)
@@ -82,22 +90,50 @@ else:
                 pass
             return self.status
 
-    driver_config = {}
-    if config.get('display_driver', 'device_name'):
-        driver_config['customer_display_device_name'] =\
-            config.get('display_driver', 'device_name')
-    if config.getint('display_driver', 'device_rate'):
-        driver_config['customer_display_device_rate'] =\
-            config.getint('display_driver', 'device_rate')
-    if config.getfloat('display_driver', 'device_timeout'):
-        driver_config['customer_display_device_timeout'] =\
-            config.getfloat('display_driver', 'device_timeout')
+    def get_driver_config(device_name):
+        driver_config = {}
+        if device_name:
+            driver_config['customer_display_device_name'] = device_name
+        if config.getint('display_driver', 'device_rate'):
+            driver_config['customer_display_device_rate'] =\
+                config.getint('display_driver', 'device_rate')
+        if config.getfloat('display_driver', 'device_timeout'):
+            driver_config['customer_display_device_timeout'] =\
+                config.getfloat('display_driver', 'device_timeout')
+        if is_virtual('display_driver'):
+            virtual_display = VirtualDisplay(
+                'display_driver',
+                baudrate=config.getint('display_driver', 'device_rate') or
+                9600)
+            driver_config['customer_display_device_name'] = \
+                virtual_display.path
+        return driver_config
+
     driver_name = 'bixolon'
     if config.has_option('display_driver', 'driver_name'):
         driver_name = config.get('display_driver', 'driver_name')
+    driver_config = get_driver_config(
+        config.get('display_driver', 'device_name'))
 
+    # The display I/O is captured through the Serial class of pyposdisplay
+    display_module = sys.modules[pyposdisplay.Driver.__module__]
+    display_module.Serial = capture.serial_class(
+        display_module.Serial, 'display')
+
+    # 10 bits per byte on the serial line
+    if config.getint('display_driver', 'device_rate'):
+        DisplayDriver.link_rate = config.getint(
+            'display_driver', 'device_rate') / 10.0
+    DisplayDriver.configure('display_driver')
     display_driver = DisplayDriver(driver_config, use_driver_name=driver_name)
     drivers['display_driver'] = display_driver
+    for lane, section in lanes.get_sections():
+        device_name = lanes.get_option(section, 'display_device')
+        if device_name or is_virtual('display_driver'):
+            lane_driver = DisplayDriver(
+                get_driver_config(device_name), use_driver_name=driver_name)
+            lane_driver.device_key = lane
+            lanes.register(lane, 'display_driver', lane_driver)
 
 
 @app.route(
@@ -107,8 +143,7 @@ else:
 @check(installed, meta)
 def send_text_customer_display():
     app.logger.debug('LCD: Call send_text')
-    text_to_display = request.json['params']['text_to_display']
-    lines = simplejson.loads(text_to_display)
+    lines = jsonrpc.decode(jsonrpc.get_params()['text_to_display'])
     app.logger.debug('LCD: lines=%s', lines)
-    display_driver.push_task('send_text', lines)
-    return jsonify(jsonrpc='2.0', result=True)
+    lanes.get_driver('display_driver').push_task('send_text', lines)
+    return jsonrpc.response(True)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""Encoding of the receipt texts to the code pages of the printers.
+
+xmlescpos encodes each character by trying the code pages one after the
+other (the current one first), with an exception for each failure. The
+result only depends on the character and on the current code page, so it
+is computed once for all the characters of the code pages: a table per
+current code page maps each character to its bytes, prefixed with the
+code page switch command when needed, and to the new current code page.
+The output is the same as the one of xmlescpos.
+"""
+
+import copy
+
+from xmlescpos.constants import (
+    TXT_ENC_PC437, TXT_ENC_PC850, TXT_ENC_PC852, TXT_ENC_PC857,
+    TXT_ENC_PC858, TXT_ENC_PC860, TXT_ENC_PC863, TXT_ENC_PC865,
+    TXT_ENC_PC866, TXT_ENC_PC862, TXT_ENC_PC720, TXT_ENC_8859_2,
+    TXT_ENC_8859_7, TXT_ENC_8859_9, TXT_ENC_WPC1254, TXT_ENC_WPC1255,
+    TXT_ENC_WPC1256, TXT_ENC_WPC1257, TXT_ENC_WPC1258, TXT_ENC_KATAKANA,
+    TXT_ENC_KATAKANA_MAP)
+
+try:
+    import jcconv
+except ImportError:
+    jcconv = None
+
+# Same dictionary as in Escpos.text: its iteration order is the order in
+# which xmlescpos tries the code pages
+ENCODINGS = {
+    'cp437': TXT_ENC_PC437,
+    'cp850': TXT_ENC_PC850,
+    'cp852': TXT_ENC_PC852,
+    'cp857': TXT_ENC_PC857,
+    'cp858': TXT_ENC_PC858,
+    'cp860': TXT_ENC_PC860,
+    'cp863': TXT_ENC_PC863,
+    'cp865': TXT_ENC_PC865,
+    'cp866': TXT_ENC_PC866,
+    'cp862': TXT_ENC_PC862,
+    'cp720': TXT_ENC_PC720,
+    'iso8859_2': TXT_ENC_8859_2,
+    'iso8859_7': TXT_ENC_8859_7,
+    'iso8859_9': TXT_ENC_8859_9,
+    'cp1254': TXT_ENC_WPC1254,
+    'cp1255': TXT_ENC_WPC1255,
+    'cp1256': TXT_ENC_WPC1256,
+    'cp1257': TXT_ENC_WPC1257,
+    'cp1258': TXT_ENC_WPC1258,
+    'katakana': TXT_ENC_KATAKANA,
+}
+ORDER = copy.copy(ENCODINGS).keys()
+
+# Code page selected before the first text, and of the error character
+DEFAULT = 'cp437'
+ERROR_CHAR = '\xb1'
+
+
+def is_katakana(char):
+    """ True if xmlescpos can print the character with the katakana code
+    page (possibly converted to several half-width katakanas) """
+    char_utf8 = char.encode('utf-8')
+    if char_utf8 in TXT_ENC_KATAKANA_MAP:
+        return True
+    return bool(jcconv) and \
+        jcconv.kata2half(jcconv.hira2kata(char_utf8)) != char_utf8
+
+
+class CodepageTables(object):
+    """ Translation tables of the given code pages. encode() returns
+    None for the texts that need the katakana conversion of xmlescpos,
+    the other characters missing from the code pages are printed as
+    ERROR_CHAR, as xmlescpos does. """
+
+    def __init__(self, encodings=None):
+        self.encodings = [
+            encoding for encoding in ORDER
+            if encodings is None or encoding in encodings or
+            encoding == DEFAULT]
+        self.katakana = 'katakana' in self.encodings
+        charmaps = {}
+        for encoding in self.encodings:
+            if encoding == 'katakana':
+                continue
+            charmap = charmaps[encoding] = {}
+            for byte in range(256):
+                try:
+                    char = chr(byte).decode(encoding)
+                except UnicodeDecodeError:
+                    continue
+                if char in charmap or self.katakana and is_katakana(char):
+                    continue
+                charmap[char] = char.encode(encoding)
+
+        # Characters missing from the current code page: the first code
+        # page having them is selected
+        switches = {}
+        for encoding in reversed(self.encodings):
+            for char, data in charmaps.get(encoding, {}).iteritems():
+                switches[char] = (ENCODINGS[encoding] + data, encoding)
+
+        self.tables = {}
+        for encoding in self.encodings:
+            table = self.tables[encoding] = dict(switches)
+            for char, data in charmaps.get(encoding, {}).iteritems():
+                table[char] = (data, encoding)
+        # Before the first text, the default code page is selected too
+        table = self.tables[None] = dict(switches)
+        for char, data in charmaps.get(DEFAULT, {}).iteritems():
+            table[char] = (ENCODINGS[DEFAULT] + data, DEFAULT)
+
+        # Current code pages printing ASCII as is
+        self.ascii = set(
+            encoding for encoding in self.encodings
+            if all(self.tables[encoding].get(chr(byte)) == (
+                chr(byte), encoding) for byte in range(128)))
+
+    def encode(self, text, encoding=None):
+        """ Return the bytes printing the unicode text with `encoding` as
+        current code page, and the new current code page """
+        if encoding not in self.tables:
+            encoding = None
+        try:
+            data = text.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+        else:
+            if encoding in self.ascii:
+                return data, encoding
+        tables = self.tables
+        table = tables[encoding]
+        output = []
+        for char in text:
+            entry = table.get(char)
+            if entry is None:
+                if self.katakana and is_katakana(char):
+                    return None
+                if encoding == DEFAULT:
+                    entry = (ERROR_CHAR, DEFAULT)
+                else:
+                    entry = (ENCODINGS[DEFAULT] + ERROR_CHAR, DEFAULT)
+            data, new_encoding = entry
+            if new_encoding != encoding:
+                encoding = new_encoding
+                table = tables[encoding]
+            output.append(data)
+        return ''.join(output), encoding
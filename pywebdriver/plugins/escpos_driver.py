@@ -22,12 +22,24 @@
 
 from pif import get_public_ip
 from pywebdriver import app, config, drivers
+from pywebdriver import capture
+from pywebdriver import idempotency
+from pywebdriver import jsonrpc
+from pywebdriver import lanes
+from pywebdriver import tracing
 from netifaces import interfaces, ifaddresses, AF_INET
 from flask_cors import cross_origin
-from flask import request, jsonify, render_template
-from base_driver import ThreadDriver
+from flask import render_template
+from base_driver import AbstractDriver, TaskAbandoned, ThreadDriver
+from collections import OrderedDict
+from threading import Lock
+from virtual_device import VirtualUsbPrinter, is_virtual, virtual_option
+from escpos_network import NetworkDevice, parse_address
+from hashlib import md5
 import usb.core
+import usb.util
 import math
+import time
 
 
 meta = {
@@ -41,46 +53,133 @@ meta = {
 try:
     from xmlescpos.printer import Usb
     from xmlescpos.supported_devices import device_list
+    import escpos_codepage
+    import escpos_image
 except ImportError:
     installed = False
     print 'ESCPOS: xmlescpos python library not installed'
 else:
+    def supported_devices():
+        return device_list
+
+    def connected_usb_devices():
+        """ Return the connected supported printers. The bus and the address
+        of each device allow to tell apart identical printers """
+        connected = []
+
+        for device in supported_devices():
+            for usb_device in usb.core.find(
+                    find_all=True,
+                    idVendor=device['vendor'],
+                    idProduct=device['product']):
+                printer = dict(device)
+                printer.update({
+                    'bus': usb_device.bus,
+                    'address': usb_device.address,
+                })
+                connected.append(printer)
+
+        return connected
+
     class ESCPOSDriver(ThreadDriver, Usb):
         """ ESCPOS Printer Driver class for pywebdriver """
 
-        def __init__(self, *args, **kwargs):
-            self.eprint = None
+        status_interval = 5
+        event_source = 'escpos'
+        queue_policies = {'printstatus': 'coalesce'}
+        # Size (in bytes) of the receive buffer of the printer. The commands
+        # are buffered and sent in transfers of this size, rounded down to
+        # a multiple of the max packet size of the out endpoint
+        buffer_size = 4096
+        # Printing speed (in bytes/s): the paper, not the USB link, limits
+        # the throughput of the printers
+        link_rate = 6000
+
+        def __init__(self, printer=None, virtual_printer=None,
+                     network_printer=None):
             self.vendor_product = None
-            ThreadDriver.__init__(self, args, kwargs)
-
-        def supported_devices(self):
-            return device_list
-
-        def connected_usb_devices(self):
-            connected = []
-
-            for device in self.supported_devices():
-                if usb.core.find(
-                        idVendor=device['vendor'],
-                        idProduct=device['product']) is not None:
-                    connected.append(device)
-
-            return connected
+            self.printer = printer
+            self.virtual_printer = virtual_printer
+            self.network_printer = network_printer
+            self.pool = None
+            self.usb_bus = None
+            self.usb_address = None
+            self.interface = 0
+            self.in_ep = 0x82
+            self.out_ep = 0x01
+            self.max_packet_size = 64
+            self.output = []
+            self.output_size = 0
+            ThreadDriver.__init__(self)
+            if virtual_printer:
+                self.link_rate = virtual_printer.print_rate
+
+        def is_available(self):
+            """ A printer is available once its status has been read and
+            is online without error """
+            return self.status['status'] == 'connected'
+
+        def open(self):
+            """ Search the device on the USB tree. Unlike Usb.open, the bus
+            and the address are used when they are known """
+            kwargs = {'idVendor': self.idVendor, 'idProduct': self.idProduct}
+            if self.usb_bus is not None:
+                kwargs.update(bus=self.usb_bus, address=self.usb_address)
+            self.device = usb.core.find(**kwargs)
+            if self.device is None:
+                raise IOError('Printer %s_%s not found' % (
+                    self.idVendor, self.idProduct))
+
+            if self.device.is_kernel_driver_active(self.interface):
+                self.device.detach_kernel_driver(self.interface)
+            self.device.set_configuration()
+
+            endpoint = usb.util.find_descriptor(
+                self.device.get_active_configuration()[(self.interface, 0)],
+                bEndpointAddress=self.out_ep)
+            if endpoint is not None:
+                self.max_packet_size = endpoint.wMaxPacketSize
 
         def open_printer(self):
 
             if self.device:
                 return
+            self._open_printer()
+            self.device = capture.wrap_device(
+                self.device, 'escpos:%s' % (self.device_key or 'usb'))
+
+        def _open_printer(self):
+            if self.virtual_printer:
+                self.device = self.virtual_printer
+                self.max_packet_size = self.virtual_printer.max_packet_size
+                return
+
+            if self.network_printer:
+                try:
+                    self.network_printer.connect()
+                except IOError as e:
+                    self.set_status('error', str(e))
+                else:
+                    self.device = self.network_printer
+                    self.max_packet_size = \
+                        self.network_printer.max_packet_size
+                return
 
             try:
-                printers = self.connected_usb_devices()
-                if printers:
-                    printer = printers[0]
+                printer = self.printer
+                if not printer:
+                    printers = connected_usb_devices()
+                    if self.pool:
+                        printers = filter(self.pool.accepts, printers)
+                    printer = printers and printers[0]
+                if printer:
                     self.idVendor = printer.get('vendor')
                     self.idProduct = printer.get('product')
                     self.interface = printer.get('interface', 0)
                     self.in_ep = printer.get('in_ep', 0x82)
                     self.out_ep = printer.get('out_ep', 0x01)
+                    self.usb_bus = printer.get('bus')
+                    self.usb_address = printer.get('address')
                     self.open()
                     self.vendor_product = '%s_%s' % (
                         self.idVendor, self.idProduct
@@ -89,16 +188,166 @@ else:
             except Exception as e:
                 self.set_status('error', str(e))
 
-        def open_cashbox(self, printer):
+        def process_task(self, task, timestamp, data):
             self.open_printer()
+            try:
+                result = super(ESCPOSDriver, self).process_task(
+                    task, timestamp, data)
+            except Exception:
+                self.output, self.output_size = [], 0
+                raise
+            self.flush()
+            return result
+
+        def get_task_timeout(self, task, job_id=None):
+            """ A batch of receipts lasts as long as its receipts: twice
+            its estimated duration is added to its timeout """
+            timeout = ThreadDriver.get_task_timeout(self, task, job_id)
+            job = self.jobs.get(job_id)
+            if task == 'receipts' and timeout and job:
+                timeout += 2 * job['estimate']
+            return timeout
+
+        def estimate_size(self, task, data):
+            """ The xml receipts are sized with the raster of their
+            images """
+            if task == 'receipt':
+                return escpos_image.receipt_size(data)
+            if task == 'receipts':
+                return sum(
+                    escpos_image.receipt_size(receipt) for receipt in data)
+            return ThreadDriver.estimate_size(self, task, data)
+
+        def get_transfer_size(self):
+            return max(
+                self.max_packet_size,
+                self.buffer_size - self.buffer_size % self.max_packet_size)
+
+        def _raw(self, msg):
+            """ Buffer the commands, the full transfers are sent at once
+            and the rest by flush() """
+            self.check_abandoned()
+            self.output.append(msg)
+            self.output_size += len(msg)
+            if self.output_size >= self.get_transfer_size():
+                self.flush(full_only=True)
+
+        def flush(self, full_only=False):
+            """ Send the buffered commands (only the full transfers with
+            full_only) """
+            self.check_abandoned()
+            if not self.output:
+                return
+            data = ''.join(self.output)
+            size = self.get_transfer_size()
+            end = len(data) - len(data) % size if full_only else len(data)
+            rest = data[end:]
+            self.output = rest and [rest] or []
+            self.output_size = len(rest)
+            for start in range(0, end, size):
+                self._write(data[start:start + size])
+
+        def _write(self, data):
+            self.check_abandoned()
+            if tracing.current() is None:
+                return Usb._raw(self, data)
+            start = time.time()
+            try:
+                return Usb._raw(self, data)
+            finally:
+                tracing.accumulate('transfer', start, time.time(), len(data))
+
+        def text(self, txt):
+            """ Same as Escpos.text, with the characters encoded by the
+            code page tables """
+            if not txt:
+                return
+            try:
+                txt = txt.decode('utf-8')
+            except:
+                try:
+                    txt = txt.decode('utf-16')
+                except:
+                    pass
+            result = None
+            if isinstance(txt, unicode):
+                result = codepage_tables.encode(txt, self.encoding)
+            if result is None:
+                # Japanese or undecodable text
+                return Usb.text(self, txt)
+            data, self.encoding = result
+            self._raw(data)
+
+        def receipt(self, xml):
+            with tracing.span('render'):
+                return Usb.receipt(self, xml)
+
+        def cut(self, mode=''):
+            with tracing.span('cut'):
+                Usb.cut(self, mode)
+                self.flush()
+
+        def cashdraw(self, pin):
+            Usb.cashdraw(self, pin)
+            self.flush()
+
+        def get_printer_status(self):
+            self.flush()
+            return Usb.get_printer_status(self)
+
+        def reset_device(self):
+            self.output, self.output_size = [], 0
+            device, self.device = self.device, None
+            if self.network_printer:
+                self.network_printer.close()
+            elif device and not self.virtual_printer:
+                usb.util.dispose_resources(capture.unwrap_device(device))
+
+        def print_base64_image(self, img):
+            """ Same as Usb.print_base64_image, with the conversion done
+            by escpos_image when numpy is available """
+            if escpos_image.numpy is None:
+                return Usb.print_base64_image(self, img)
+            key = md5(img).digest()
+            if key not in self.img_cache:
+                self.img_cache[key] = escpos_image.base64_to_raster(img)
+            self._raw(self.img_cache[key])
+
+        def receipts(self, receipts):
+            """ Print a batch of xml receipts, opening the printer once.
+            Each receipt is cut, and its own result is returned. The batch
+            stops when the watchdog abandons it """
+            results = []
+            for receipt in receipts:
+                self.check_abandoned()
+                try:
+                    self.receipt(receipt)
+                    results.append({'state': 'done'})
+                except TaskAbandoned:
+                    raise
+                except Exception as e:
+                    app.logger.error('ESCPOS: batch receipt failed: %s', e)
+                    results.append({'state': 'error', 'message': str(e)})
+            return results
+
+        def open_cashbox(self, printer):
             self.cashdraw(2)
             self.cashdraw(5)
 
         def get_status(self):
+            """ Return the last status read by the driver thread, without
+            any access to the device. The status is replaced as a whole by
+            the other threads: a copy of the current one is consistent """
+            self.lockedstart()
+            return dict(self.status)
+
+        def refresh_status(self):
             messages = []
             self.open_printer()
             if not self.device:
                 status = 'disconnected'
+                if self.network_printer and self.network_printer.last_error:
+                    messages.append(self.network_printer.last_error)
             else:
                 try:
                     res = self.get_printer_status()
@@ -112,21 +361,27 @@ else:
                         messages.append(
                             'Error code: %i' % res['printer']['status_error'])
 
+                except TaskAbandoned:
+                    raise
                 except Exception, err:
                     status = 'error'
                     self.device = False
                     messages.append('Error: %s' % err)
 
-            return {
+            if self.virtual_printer:
+                messages += self.virtual_printer.get_status()['messages']
+
+            self.status = {
                 'status': status,
                 'messages': messages,
             }
+            if status == 'error' and self.pool:
+                self.pool.failover(self)
 
         def printstatus(self, eprint):
             # <PyWebDriver> Full refactoring of the function to allow
             # localisation and to make more easy the search of the ip
 
-            self.open_printer()
             ip = get_public_ip()
 
             if not ip:
@@ -211,15 +466,10 @@ else:
                         tax['tax']['name'], price(tax['amount']), width=40,
                         ratio=0.6))
 
-            if not self.eprint:
-                printers = self.connected_usb_devices()
-                if len(printers) > 0:
-                    self.eprint = Usb(
-                        printers[0]['vendor'], printers[0]['product'])
-                else:
-                    return
+            if not self.device:
+                return
 
-            eprint = self.eprint
+            eprint = self
 
             # Receipt Header
             if receipt['company'].get('logo', False):
@@ -340,8 +590,247 @@ else:
         # </Odoo Version 7>
         # #####################################################################
 
-    driver = ESCPOSDriver(app.config)
+    class ESCPOSPool(AbstractDriver):
+        """ Pool of the connected ESCPOS printers.
+        Each printer has its own driver thread. The receipts are sent to
+        the least loaded available printer, and the queued receipts of a
+        printer in error are moved to the other ones. The other tasks (cash
+        drawer, status page) go to the printer the drawer is wired to. """
+
+        # Delay (in seconds) between two scans of the USB tree
+        refresh_interval = 10
+        # Tasks sent to any printer of the pool
+        balanced_tasks = ('receipt', 'receipts', 'print_receipt_7')
+
+        def __init__(self, virtual_printers=0, network_printers=(),
+                     usb_printers=None, lane=None, cashbox_printer=None):
+            AbstractDriver.__init__(self)
+            self.printers = OrderedDict()
+            self.lock = Lock()
+            self.last_refresh = 0
+            self.virtual = bool(virtual_printers)
+            # USB printers of the pool, as vendor_product or
+            # vendor_product@bus-address (None: the ones of no lane)
+            self.usb_printers = usb_printers
+            self.lane = lane
+            # Printer of the cash drawer, as key or vendor_product (None:
+            # the first printer)
+            self.cashbox_printer = cashbox_printer
+            for network_printer in network_printers:
+                self.add_printer('%s:%s' % (
+                    network_printer.host, network_printer.port),
+                    network_printer=network_printer)
+            for index in range(virtual_printers):
+                self.add_printer('virtual-%i' % index, virtual_printer=(
+                    VirtualUsbPrinter(
+                        usb_rate=virtual_option(
+                            'escpos_driver', 'usb_rate', 1000000),
+                        buffer_size=virtual_option(
+                            'escpos_driver', 'buffer_size', 4096),
+                        print_rate=virtual_option(
+                            'escpos_driver', 'print_rate', 6000),
+                    )))
+
+        def add_printer(self, key, printer=None, virtual_printer=None,
+                        network_printer=None):
+            driver = ESCPOSDriver(
+                printer=printer, virtual_printer=virtual_printer,
+                network_printer=network_printer)
+            driver.pool = self
+            driver.device_key = key
+            if self.lane:
+                driver.device_key = '%s/%s' % (self.lane, key)
+            self.printers[key] = driver
+            return driver
+
+        def accepts(self, printer):
+            """ True if the connected USB printer belongs to the pool """
+            vendor_product = '%s_%s' % (printer['vendor'], printer['product'])
+            keys = (vendor_product, '%s@%s-%s' % (
+                vendor_product, printer['bus'], printer['address']))
+            if self.usb_printers is None:
+                return not any(key in lane_usb_printers for key in keys)
+            return any(key in self.usb_printers for key in keys)
+
+        def refresh(self):
+            """ Add a driver for each newly connected printer """
+            with self.lock:
+                self.last_refresh = time.time()
+                if self.virtual:
+                    return
+                try:
+                    connected = connected_usb_devices()
+                except Exception as e:
+                    app.logger.error('ESCPOS: unable to scan USB: %s', e)
+                    return
+                for printer in filter(self.accepts, connected):
+                    key = '%s_%s@%s-%s' % (
+                        printer['vendor'], printer['product'],
+                        printer['bus'], printer['address'])
+                    if key not in self.printers:
+                        app.logger.info('ESCPOS: printer %s found', key)
+                        self.add_printer(key, printer=printer)
+                default = self.printers.get('default')
+                if default and len(self.printers) > 1:
+                    del self.printers['default']
+                    for item, job in default.take_pending():
+                        self.printers.values()[0].requeue(item, job)
+                elif not self.printers:
+                    # Keep the original behaviour: the jobs are queued
+                    # and printed by the first printer that will be found
+                    self.add_printer('default')
+
+        def _refresh_if_needed(self):
+            if not self.printers or \
+                    time.time() - self.last_refresh > self.refresh_interval:
+                self.refresh()
+
+        def select_printer(self):
+            self._refresh_if_needed()
+            printers = [
+                printer for printer in self.printers.values()
+                if printer.is_available()] or self.printers.values()
+            # The printer which will be done first, whatever the number of
+            # jobs it has: a long receipt costs more than a short one
+            return min(printers, key=lambda printer: (
+                printer.get_queue_estimate()[0], printer.get_load()))
+
+        def pinned_printer(self):
+            """ Return the printer the cash drawer is wired to """
+            self._refresh_if_needed()
+            for key, printer in self.printers.items():
+                if self.cashbox_printer in (key, key.split('@')[0]):
+                    return printer
+            return self.printers.values()[0]
+
+        def push_task(self, task, data=None):
+            if task in self.balanced_tasks:
+                return self.select_printer().push_task(task, data)
+            return self.pinned_printer().push_task(task, data)
+
+        def failover(self, printer):
+            """ Called by the thread of a printer whose status refresh
+            found an error: move its queued receipts to the available
+            printers """
+            available = [
+                other for other in self.printers.values()
+                if other is not printer and other.is_available()]
+            if not available:
+                return
+            for item, job in printer.take_pending():
+                if item[1] not in self.balanced_tasks:
+                    printer.requeue(item, job)
+                    continue
+                target = min(available, key=lambda other: other.get_load())
+                app.logger.warning(
+                    'ESCPOS: job %s moved from printer %s', item[3],
+                    printer.device_key)
+                target.requeue(item, job)
+
+        def get_job(self, job_id):
+            for printer in self.printers.values():
+                job = printer.get_job(job_id)
+                if job:
+                    return job
+            return None
+
+        def get_load(self):
+            return sum(
+                printer.get_load() for printer in self.printers.values())
+
+        def get_queue_status(self):
+            statuses = [
+                printer.get_queue_status()
+                for printer in self.printers.values()]
+            return {
+                'jobs': sum(status['jobs'] for status in statuses),
+                'eta': max([status['eta'] for status in statuses] or [0.0]),
+                'job_etas': sorted(
+                    [job_eta for status in statuses
+                     for job_eta in status['job_etas']],
+                    key=lambda job_eta: job_eta['job_id']),
+            }
+
+        def get_vendor_product(self):
+            for printer in self.printers.values():
+                vendor_product = printer.get_vendor_product()
+                if vendor_product:
+                    return vendor_product
+            return None
+
+        def get_status(self):
+            self._refresh_if_needed()
+            statuses = [
+                (key, printer.get_status())
+                for key, printer in self.printers.items()]
+            if len(statuses) == 1:
+                return statuses[0][1]
+            status = 'disconnected'
+            messages = []
+            for state in ('error', 'connecting', 'connected'):
+                if state in [printer_status['status']
+                             for key, printer_status in statuses]:
+                    status = state
+            for key, printer_status in statuses:
+                messages.append('%s: %s' % (key, printer_status['status']))
+                messages += printer_status['messages']
+            return {
+                'status': status,
+                'messages': messages,
+            }
+
+    if config.has_option('escpos_driver', 'status_interval'):
+        ESCPOSDriver.status_interval = config.getfloat(
+            'escpos_driver', 'status_interval')
+    ESCPOSDriver.configure('escpos_driver')
+    if config.has_option('escpos_driver', 'buffer_size'):
+        ESCPOSDriver.buffer_size = config.getint(
+            'escpos_driver', 'buffer_size')
+    codepages = None
+    if config.has_option('escpos_driver', 'codepages'):
+        codepages = config.get('escpos_driver', 'codepages').split()
+    codepage_tables = escpos_codepage.CodepageTables(codepages)
+
+    virtual_printers = 0
+    if is_virtual('escpos_driver'):
+        virtual_printers = virtual_option('escpos_driver', 'printers', 1)
+    network_options = {}
+    for option in ('network_timeout', 'network_keepalive'):
+        if config.has_option('escpos_driver', option):
+            network_options[option[len('network_'):]] = \
+                config.getfloat('escpos_driver', option)
+
+    def get_network_printers(addresses):
+        network_printers = []
+        for address in addresses.split():
+            host, port = parse_address(address)
+            network_printers.append(
+                NetworkDevice(host, port, **network_options))
+        return network_printers
+
+    # The USB printers of the lanes are not used by the default pool
+    lane_usb_printers = set()
+    for lane, section in lanes.get_sections():
+        lane_usb_printers.update(
+            lanes.get_option(section, 'usb_printers', '').split())
+
+    driver = ESCPOSPool(
+        virtual_printers=virtual_printers,
+        network_printers=get_network_printers(
+            lanes.get_option('escpos_driver', 'network_printers', '')),
+        cashbox_printer=lanes.get_option('escpos_driver', 'cashbox_printer'))
     drivers['escpos'] = driver
+    for lane, section in lanes.get_sections():
+        usb_printers = lanes.get_option(section, 'usb_printers')
+        network_printers = lanes.get_option(section, 'network_printers')
+        if usb_printers is None and network_printers is None and \
+                not virtual_printers:
+            continue
+        lanes.register(lane, 'escpos', ESCPOSPool(
+            virtual_printers=virtual_printers,
+            network_printers=get_network_printers(network_printers or ''),
+            usb_printers=(usb_printers or '').split(), lane=lane,
+            cashbox_printer=lanes.get_option(section, 'cashbox_printer')))
     installed = True
 
     @app.route(
@@ -351,16 +840,43 @@ else:
     def print_xml_receipt_json():
         """ For Odoo 8.0+"""
 
-        driver.open_printer()
-        receipt = request.json['params']['receipt']
-        driver.push_task('receipt', receipt)
+        params = jsonrpc.get_params()
+        receipt = params['receipt']
+        idempotency.run(
+            idempotency.get_key('print_xml_receipt', params, receipt),
+            lanes.get_driver('escpos').push_task, 'receipt', receipt)
+
+        return jsonrpc.response(True)
+
+    @app.route(
+            '/hw_proxy/print_xml_receipts',
+            methods=['POST', 'GET', 'PUT', 'OPTIONS'])
+    @cross_origin(headers=['Content-Type'])
+    def print_xml_receipts_json():
+        """ Print several xml receipts in one job. The result of each
+        receipt can be read afterwards with /hw_proxy/job_status """
+        params = jsonrpc.get_params()
+        receipts = params['receipts']
+        pool = lanes.get_driver('escpos')
+
+        def print_receipts():
+            job_id = pool.push_task('receipts', receipts)
+            return {
+                'driver': 'escpos',
+                'job_id': job_id,
+                'receipts': [
+                    {'index': index, 'state': 'queued'}
+                    for index in range(len(receipts))],
+            }
 
-        return jsonify(jsonrpc='2.0', result=True)
+        return jsonrpc.response(idempotency.run(
+            idempotency.get_key('print_xml_receipts', params, receipts),
+            print_receipts))
 
     @app.route('/print_status.html', methods=['GET'])
     @cross_origin()
     def print_status_http():
-        driver.push_task('printstatus')
+        lanes.get_driver('escpos').push_task('printstatus')
         return render_template('print_status.html')
 
     @app.route(
@@ -368,5 +884,9 @@ else:
         methods=['POST', 'GET', 'PUT', 'OPTIONS'])
     @cross_origin(headers=['Content-Type'])
     def open_cashbox():
-        driver.push_task('open_cashbox')
-        return jsonify(jsonrpc='2.0', result=True)
+        # Opening the drawer twice is legitimate: only the requests with
+        # an explicit idempotency key are deduplicated
+        idempotency.run(
+            idempotency.get_key('open_cashbox', jsonrpc.get_params()),
+            lanes.get_driver('escpos').push_task, 'open_cashbox')
+        return jsonrpc.response(True)
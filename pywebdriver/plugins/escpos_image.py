@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""Conversion of images to ESC/POS raster commands with numpy.
+
+The rendering is the one of xmlescpos (dark pixels are printed, middle
+gray pixels are dithered with a checkerboard, light pixels are blank), but
+the pixels are processed as arrays instead of one by one. Large images are
+converted in a process pool so that the HTTP threads are not slowed down.
+"""
+
+import base64
+import io
+import multiprocessing
+import re
+import threading
+
+from PIL import Image
+
+from pywebdriver import app, config
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+    app.logger.info(
+        'ESCPOS: numpy not installed, images are converted by xmlescpos')
+
+# GS v 0, normal mode
+S_RASTER_N = '\x1d\x76\x30\x00'
+
+# Image sources of an xml receipt
+IMAGE_SRC = re.compile(r'<img\b[^>]*\bsrc\s*=\s*["\']([^"\']*)')
+
+# Images with more pixels than this value are converted in the process pool
+pool_threshold = 512 * 512
+if config.has_option('escpos_driver', 'image_pool_threshold'):
+    pool_threshold = config.getint('escpos_driver', 'image_pool_threshold')
+
+processes = 1
+if config.has_option('escpos_driver', 'image_processes'):
+    processes = config.getint('escpos_driver', 'image_processes')
+
+
+def decode_base64_image(data):
+    """ Return the RGB image of a base64 string (or data url), the
+    transparent pixels being white """
+    data = data[data.find(',') + 1:]
+    image_rgba = Image.open(io.BytesIO(base64.b64decode(data)))
+    image = Image.new('RGB', image_rgba.size, (255, 255, 255))
+    channels = image_rgba.split()
+    if len(channels) > 1:
+        # use alpha channel as mask
+        image.paste(image_rgba, mask=channels[-1])
+    else:
+        image.paste(image_rgba)
+    return image
+
+
+def convert_pixels(size, data):
+    """ Convert the RGB pixels of an image to a raster command """
+    width, height = size
+    pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape(
+        (height, width, 3))
+
+    # Grayscale and thresholds, as xmlescpos: dark (sum <= 255) dots are
+    # printed, middle (sum <= 510) dots alternate, light dots are blank
+    color = pixels.sum(axis=2, dtype=numpy.uint16)
+    index = numpy.arange(width * height).reshape((height, width))
+    dots = (color <= 255) | ((color <= 510) & (index % 2 == 0))
+
+    # Borders to get a width multiple of 32 dots
+    border = (32 - width % 32) % 32
+    dots = numpy.pad(
+        dots, ((0, 0), (border / 2, border - border / 2)), 'constant')
+
+    raster = numpy.packbits(dots, axis=1)
+    line_bytes = raster.shape[1]
+    return S_RASTER_N + ''.join(chr(value) for value in (
+        line_bytes % 256, line_bytes / 256, height % 256, height / 256)) + \
+        raster.tostring()
+
+
+def convert_image(image):
+    """ Return the raster command printing the RGB image """
+    args = (image.size, image.tobytes())
+    if processes and image.size[0] * image.size[1] > pool_threshold:
+        return get_pool().apply(convert_pixels, args)
+    return convert_pixels(*args)
+
+
+def base64_to_raster(data):
+    return convert_image(decode_base64_image(data))
+
+
+def raster_size(data):
+    """ Return the size (in bytes) of the raster command printing a
+    base64 image (or data url). Only the header of the image is read """
+    width, height = Image.open(io.BytesIO(base64.b64decode(
+        data[data.find(',') + 1:]))).size
+    return len(S_RASTER_N) + 4 + (width + 31) / 32 * 4 * height
+
+
+# Image source hash -> raster size
+raster_sizes = {}
+
+
+def receipt_size(receipt):
+    """ Return the estimated size (in bytes) of the commands printing an
+    xml receipt: the size of its text, the images counting for the size of
+    their raster (a logo is a large part of the printing time) """
+    size = len(receipt)
+    for src in IMAGE_SRC.findall(receipt):
+        key = hash(src)
+        if key not in raster_sizes:
+            if len(raster_sizes) > 100:
+                raster_sizes.clear()
+            try:
+                raster_sizes[key] = raster_size(src)
+            except Exception:
+                raster_sizes[key] = len(src)
+        size += raster_sizes[key] - len(src)
+    return size
+
+
+# The pool is only created for the first large image, so that the
+# instances printing no image do not start its processes. The workers only
+# run convert_pixels, which needs no lock of the forked process
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = multiprocessing.Pool(processes)
+        return pool
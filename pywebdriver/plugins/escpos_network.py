@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""ESC/POS printers connected on the network (raw TCP, port 9100).
+
+A NetworkDevice exposes the subset of the pyusb device API used by the
+xmlescpos library (write and read with an endpoint), so that a network
+printer is driven by the same ESCPOSDriver as the USB ones. The TCP
+connection is kept open between the jobs, with TCP keepalive, and opened
+again when the printer closed it or after an error.
+"""
+
+import array
+import errno
+import select
+import socket
+import time
+
+# Errors of a non-blocking socket meaning "try again"
+RETRY_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+def parse_address(address, default_port=9100):
+    """ Return (host, port) of a 'host' or 'host:port' string """
+    host, sep, port = address.rpartition(':')
+    if not sep:
+        return address, default_port
+    return host, int(port)
+
+
+class NetworkDevice(object):
+    """ Persistent TCP connection to an ESC/POS printer. The writes are
+    done on a non-blocking socket, waiting with select for at most
+    `timeout` seconds each time the printer does not accept data. After
+    a failed connection, the next attempts are delayed (from 1 to
+    `max_retry_delay` seconds) so that a printer switched off does not
+    block its driver thread. """
+
+    # The socket is a stream: the transfers do not need to be aligned
+    max_packet_size = 1
+    max_retry_delay = 30
+
+    def __init__(self, host, port=9100, timeout=5, keepalive=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.socket = None
+        self.last_error = None
+        self.retry_delay = 0
+        self.retry_time = 0
+        self.connections = 0
+
+    def __repr__(self):
+        return '<NetworkDevice %s:%s>' % (self.host, self.port)
+
+    def connect(self):
+        """ Open the connection if it is not open yet """
+        if self.socket is not None:
+            return
+        if time.time() < self.retry_time:
+            raise IOError(self.last_error)
+        try:
+            sock = socket.create_connection(
+                (self.host, self.port), self.timeout)
+        except socket.error, e:
+            self.retry_delay = min(
+                self.retry_delay * 2 or 1, self.max_retry_delay)
+            self.retry_time = time.time() + self.retry_delay
+            self.last_error = 'Printer %s:%s unreachable: %s' % (
+                self.host, self.port, e)
+            raise IOError(self.last_error)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # Linux only: probe after keepalive idle seconds
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                    int(self.keepalive))
+                sock.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                    max(1, int(self.keepalive) / 6))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        sock.setblocking(0)
+        self.socket = sock
+        self.last_error = None
+        self.retry_delay = 0
+        self.connections += 1
+
+    def close(self):
+        sock, self.socket = self.socket, None
+        if sock is not None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+
+    def _fail(self, message):
+        self.close()
+        self.last_error = 'Printer %s:%s: %s' % (
+            self.host, self.port, message)
+        raise IOError(self.last_error)
+
+    def _check_connection(self):
+        """ Discard the data not read yet (late answers) and detect the
+        connections closed by the printer """
+        while select.select([self.socket], [], [], 0)[0]:
+            try:
+                data = self.socket.recv(4096)
+            except socket.error, e:
+                if e.args[0] in RETRY_ERRORS:
+                    return True
+                data = ''
+            if not data:
+                self.close()
+                return False
+        return True
+
+    def write(self, endpoint, data, interface=None, timeout=None):
+        if isinstance(data, array.array):
+            data = data.tostring()
+        self.connect()
+        if not self._check_connection():
+            # Closed by the printer since the last job (idle timeout)
+            self.connect()
+        view = memoryview(data)
+        while view:
+            if not select.select([], [self.socket], [], self.timeout)[1]:
+                self._fail('write timeout')
+            try:
+                sent = self.socket.send(view)
+            except socket.error, e:
+                if e.args[0] in RETRY_ERRORS:
+                    continue
+                self._fail(e)
+            view = view[sent:]
+        return len(data)
+
+    def read(self, endpoint, size, interface=None, timeout=None):
+        """ Return the available bytes, waiting for at least one of them
+        for `timeout` seconds """
+        self.connect()
+        if not select.select([self.socket], [], [], self.timeout)[0]:
+            self._fail('no answer')
+        try:
+            data = self.socket.recv(size)
+        except socket.error, e:
+            if e.args[0] in RETRY_ERRORS:
+                return array.array('B')
+            self._fail(e)
+        if not data:
+            self._fail('connection closed')
+        return array.array('B', data)
@@ -19,31 +19,36 @@
 #
 ###############################################################################
 
-import simplejson
-import json
-
 from flask_cors import cross_origin
-from flask import request, make_response, jsonify
+from flask import make_response
 
-from pywebdriver import app, config, drivers
+from pywebdriver import app, config
+from pywebdriver import idempotency
+from pywebdriver import jsonrpc
+from pywebdriver import lanes
 
 
 @app.route('/pos/print_receipt', methods=['POST'])
 @cross_origin(headers=['Content-Type'])
 def print_receipt_http_post():
-    receipt = json.loads(request.form['r'])['params']['receipt']
-    print_receipt(receipt)
-    return jsonify(jsonrpc='2.0', result=True)
+    params = jsonrpc.get_params(form_field='r')
+    receipt = params['receipt']
+    idempotency.run(
+        idempotency.get_key('print_receipt', params, receipt),
+        print_receipt, receipt)
+    return jsonrpc.response(True)
 
 
 @app.route('/pos/print_receipt', methods=['GET'])
 @cross_origin()
 def print_receipt_http_get():
-    params = dict(request.args)
-    if not params.get('r'):
+    params = jsonrpc.get_params(form_field='r')
+    if not params:
         return make_response('')
-    receipt = simplejson.loads(params['r'][0])['params']['receipt']
-    print_receipt(receipt)
+    receipt = params['receipt']
+    idempotency.run(
+        idempotency.get_key('print_receipt', params, receipt),
+        print_receipt, receipt)
     return make_response('')
 
 
@@ -64,4 +69,4 @@ def print_receipt(receipt):
         if not receipt['precision'].get('quantity', False):
             receipt['precision']['quantity'] = config.getint(
                 'odoo', 'precision_quantity')
-    drivers['escpos'].push_task('print_receipt_7', receipt)
+    lanes.get_driver('escpos').push_task('print_receipt_7', receipt)
@@ -21,9 +21,14 @@
 ###############################################################################
 
 from flask_cors import cross_origin
-from flask import request, make_response, jsonify
+from flask import Response, make_response, request
 
-from pywebdriver import app, config, drivers
+from pywebdriver import app
+from pywebdriver import events
+from pywebdriver import jsonrpc
+from pywebdriver import lanes
+from pywebdriver import poslog
+from pywebdriver import tracing
 
 
 @app.route('/hw_proxy/hello', methods=['GET'])
@@ -35,20 +40,75 @@ def hello_http():
 @app.route('/hw_proxy/handshake', methods=['POST', 'GET', 'PUT', 'OPTIONS'])
 @cross_origin(headers=['Content-Type'])
 def handshake_json():
-    return jsonify(jsonrpc='2.0', result=True)
+    return jsonrpc.response(True)
 
 
 @app.route('/hw_proxy/status_json', methods=['POST', 'GET', 'PUT', 'OPTIONS'])
 @cross_origin(headers=['Content-Type'])
 def status_json():
     statuses = {}
-    for driver in drivers:
-        statuses[driver] = drivers[driver].get_status()
-    return jsonify(jsonrpc='2.0', result=statuses)
+    for name, driver in lanes.get_drivers().items():
+        statuses[name] = driver.get_status()
+        # Queued jobs, with the estimated time to print/send them
+        if hasattr(driver, 'get_queue_status'):
+            statuses[name] = dict(
+                statuses[name], queue=driver.get_queue_status())
+    return jsonrpc.response(statuses)
+
+@app.route('/hw_proxy/events', methods=['GET'])
+@cross_origin()
+def events_http():
+    """ Server-sent events: the status changes, the finished jobs and the
+    payment results. A new stream starts with the status of each driver,
+    a reconnecting one (Last-Event-ID) gets the events it missed """
+    last_id = request.headers.get('Last-Event-ID') or \
+        request.args.get('last_event_id')
+    initial = []
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+    if not events.bus.can_resume(last_id):
+        # New stream, malformed id, id older than the history or of a
+        # previous run: the stream starts from now with the statuses
+        last_id = None
+        initial = [
+            ('status', {
+                'driver': name,
+                'device': None,
+                'status': driver.get_status()})
+            for name, driver in lanes.get_drivers().items()]
+    return Response(
+        events.bus.stream(last_id, initial),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/hw_proxy/traces', methods=['POST', 'GET', 'PUT', 'OPTIONS'])
+@cross_origin(headers=['Content-Type'])
+def traces_json():
+    """ The last traces (request to device spans), the most recent first.
+    Params: limit (default 20), trace_id """
+    params = jsonrpc.get_params()
+    return jsonrpc.response(tracing.get_traces(
+        limit=int(params.get('limit', 20)),
+        trace_id=params.get('trace_id')))
+
+
+@app.route('/hw_proxy/job_status', methods=['POST', 'GET', 'PUT', 'OPTIONS'])
+@cross_origin(headers=['Content-Type'])
+def job_status_json():
+    params = jsonrpc.get_params()
+    driver = lanes.get_drivers().get(params.get('driver'))
+    job = None
+    if driver and hasattr(driver, 'get_job'):
+        job = driver.get_job(params.get('job_id'))
+    return jsonrpc.response(job or False)
+
 
 @app.route('/hw_proxy/log', methods=['POST', 'GET', 'PUT', 'OPTIONS'])
 @cross_origin(headers=['Content-Type'])
 def log_json():
-    arguments = request.json['params']['arguments']
-    print (' '.join(str(v) for v in arguments))
-    return jsonify(jsonrpc='2.0', result=True)
+    # Queued: the message is written by the background thread of the sink
+    poslog.push(jsonrpc.get_params()['arguments'])
+    return jsonrpc.response(True)
@@ -23,10 +23,10 @@ import logging
 import os
 import sys
 
-from flask import app, request, make_response, jsonify
 from flask_cors import cross_origin
-import simplejson as json
 from pywebdriver import app, config, drivers
+from pywebdriver import jsonrpc
+from .base_driver import executor
 
 try:
 
@@ -118,8 +118,13 @@ try:
     @app.route('/hw_proxy/opcua_write', methods=['POST'])
     @cross_origin()
     def opcua_write_http():
-        result = opcua_write(request.json)
-        return jsonify(jsonrpc='2.0', result=result)
+        payload = jsonrpc.get_payload()
+        if not isinstance(payload, dict):
+            raise jsonrpc.InvalidParams('JSON object expected')
+        result = executor.call(
+            'opcua:%s' % payload.get('url', 'opc.tcp://localhost:4841'),
+            opcua_write, payload)
+        return jsonrpc.response(result)
 
 except ImportError:
     app.logger.info('opcua lib not found, function disabled')
@@ -19,24 +19,40 @@
 #
 ###############################################################################
 
+import codecs
 import logging
 import os
+import re
 import sys
+import time
 
 import serial
 from flask_cors import cross_origin
-from flask import request, make_response, jsonify
-import simplejson as json
 
 from pywebdriver import app, config, drivers
+from pywebdriver import capture
+from pywebdriver import jsonrpc
+from pywebdriver import lanes
+from .base_driver import executor
+from .virtual_device import VirtualSerialPort, is_virtual, virtual_option
 
+virtual_port = None
+if is_virtual('serial_driver'):
+    virtual_port = VirtualSerialPort(
+        'serial_driver',
+        baudrate=config.getint('serial_driver', 'baudrate'),
+        answer=virtual_option('serial_driver', 'answer', '') or None,
+    )
 
 def serial_options(options):
 
     values = {}
     values['port'] = options.get('port',
+        lanes.get_lane_option('serial_port') or
         config.get('serial_driver', 'port') or '/dev/ttyS0'
     )
+    if virtual_port:
+        values['port'] = virtual_port.path
 
     values['baudrate'] = options.get('baudrate',
         config.getint('serial_driver', 'baudrate')
@@ -81,11 +97,14 @@ def serial_open(options):
     if sys.platform.startswith('linux') or \
         sys.platform.startswith('cygwin') or \
         sys.platform.startswith('darwin'):
-            if not port.startswith('/dev/tty'):
+            # The pty of the emulator is the only other port allowed
+            if not port.startswith('/dev/tty') and not (
+                    virtual_port and port == virtual_port.path):
                 raise serial.SerialException('%s: invalid serial port' % port)
 
     app.logger.debug('serial: open %r', options)
-    return serial.Serial(
+    serial_class = capture.serial_class(serial.Serial, 'serial:%s' % port)
+    return serial_class(
         port=options['port'],
         baudrate=options['baudrate'],
         bytesize=options['bytesize'],
@@ -102,8 +121,15 @@ def serial_close(ser):
         ser.close()
 
 
-def serial_do_operation(operation, params):
+def serial_call(operation, params):
+    """ Execute the operation in the executor, one at a time per port """
     options, data = serial_options(params)
+    return executor.call(
+        'serial:%s' % options['port'], serial_do_operation, operation,
+        options, data)
+
+
+def serial_do_operation(operation, options, data):
     result = {}
     ser = None
     try:
@@ -131,15 +157,162 @@ def serial_do_operation(operation, params):
     return result
 
 
+def serial_bytes(data, encoding):
+    """ The JSON strings are unicode: their characters are the bytes, in
+    encoding (latin-1 by default, so that any byte can be sent as \\u00XX) """
+    if isinstance(data, unicode):
+        return data.encode(encoding)
+    return data
+
+
+def serial_read_until(ser, terminator, size=None, timeout=None):
+    """ Read until the terminator, size bytes or the timeout """
+    data = ''
+    deadline = timeout and time.time() + timeout
+    while not data.endswith(terminator) and (size is None or len(data) < size):
+        if deadline:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            ser.timeout = remaining
+        char = ser.read(1)
+        if not char:
+            break
+        data += char
+    return data
+
+
+# Keys of each kind of transaction step
+STEP_KEYS = {
+    'write': set(['write', 'timeout']),
+    'read': set(['read', 'timeout', 'expect']),
+    'terminator': set(['terminator', 'max_size', 'timeout', 'expect']),
+}
+
+
+def serial_check_steps(steps):
+    """ Raise ValueError, before any I/O, for a step that is not an
+    object, that has keys unknown for its kind (a misspelled write
+    would be run as a read) or values of the wrong type """
+    if not isinstance(steps, list):
+        raise ValueError('steps: list expected')
+    for index, step in enumerate(steps, 1):
+        if not isinstance(step, dict):
+            raise ValueError('step %i: object expected' % index)
+        kind = 'write' in step and 'write' or 'read' in step and 'read' or \
+            'terminator'
+        unknown = set(step) - STEP_KEYS[kind]
+        if unknown:
+            raise ValueError('step %i: unexpected %s in a %s step' % (
+                index, ', '.join(sorted(unknown)), kind))
+        for key in ('write', 'terminator'):
+            if key in step and not isinstance(step[key], basestring):
+                raise ValueError('step %i: %s must be a string' % (
+                    index, key))
+        for key, types in (('read', (int, long)), ('max_size', (int, long)),
+                           ('timeout', (int, long, float))):
+            value = step.get(key)
+            if key in step and (isinstance(value, bool) or
+                                not isinstance(value, types) or value <= 0):
+                raise ValueError('step %i: %s must be a positive %s' % (
+                    index, key, key == 'timeout' and 'number' or 'integer'))
+
+
+def serial_run_step(ser, step, timeout, encoding, results):
+    """ Run a step of a transaction, appending its result to results """
+    ser.timeout = timeout
+    if 'write' in step:
+        data = serial_bytes(step['write'], encoding)
+        ser.write(data)
+        app.logger.debug('serial: write done (data: "%s")' % data.strip())
+        results.append({'written': len(data)})
+        return
+    if 'read' in step:
+        size = int(step['read'])
+        data = ser.read(size)
+        complete = len(data) == size
+    else:
+        terminator = serial_bytes(step.get('terminator', '\n'), encoding)
+        data = serial_read_until(
+            ser, terminator, size=step.get('max_size'), timeout=timeout)
+        complete = data.endswith(terminator)
+    app.logger.debug('serial: read done (data: "%s")' % data.strip())
+    result = {'data': data.decode(encoding), 'complete': complete}
+    results.append(result)
+    if 'expect' in step:
+        match = re.search(step['expect'], result['data'])
+        result['match'] = bool(match)
+        if not match:
+            raise serial.SerialException('%r does not match %r' % (
+                result['data'], step['expect']))
+        result['groups'] = match.groups()
+
+
+def serial_run_steps(ser, steps, timeout, encoding, results):
+    """ Run the steps of a transaction on the open port, appending the
+    result of each step to results. Stop at the first failing step """
+    # A late answer to a previous command is not the answer to this one
+    if hasattr(ser, 'reset_input_buffer'):
+        ser.reset_input_buffer()
+    else:
+        ser.flushInput()
+    for index, step in enumerate(steps, 1):
+        try:
+            serial_run_step(
+                ser, step, step.get('timeout', timeout), encoding, results)
+        except (serial.SerialException, ValueError, LookupError, TypeError,
+                re.error), message:
+            raise serial.SerialException('step %i: %s' % (index, message))
+
+
+def serial_do_transaction(options, steps, encoding):
+    result = {'steps': []}
+    ser = None
+    try:
+        serial_check_steps(steps)
+        codecs.lookup(encoding)
+        ser = serial_open(options)
+        serial_run_steps(
+            ser, steps, options['timeout'], encoding, result['steps'])
+        result['status'] = 'ok'
+    except (serial.SerialException, ValueError, LookupError, TypeError,
+            re.error), message:
+        result['status'] = 'error'
+        result['message'] = str(message)
+
+    serial_close(ser)
+
+    return result
+
+
 @app.route('/hw_proxy/serial_read', methods=['POST'])
 @cross_origin()
 def serial_read_http():
-    result = serial_do_operation('read', request.json)
-    return jsonify(jsonrpc='2.0', result=result)
+    result = serial_call('read', jsonrpc.get_payload())
+    return jsonrpc.response(result)
 
 
 @app.route('/hw_proxy/serial_write', methods=['POST'])
 @cross_origin()
 def serial_write_http():
-    result = serial_do_operation('write', request.json)
-    return jsonify(jsonrpc='2.0', result=result)
+    result = serial_call('write', jsonrpc.get_payload())
+    return jsonrpc.response(result)
+
+
+@app.route('/hw_proxy/serial_transaction', methods=['POST'])
+@cross_origin()
+def serial_transaction_http():
+    """ Run a list of steps on the port, opened once, and return the
+    result of each one. A step writes ({"write": data}), or reads size
+    bytes ({"read": size}) or up to a terminator ({"terminator": "\\r\\n",
+    "max_size": size}, the default terminator is "\\n"), within its own
+    timeout (in seconds). The data read can be checked with an "expect"
+    regular expression: the transaction stops with an error when it does
+    not match. The data are strings of bytes in `encoding` (latin-1 by
+    default). The steps with unknown keys are rejected before any I/O """
+    payload = jsonrpc.get_payload() or {}
+    options, data = serial_options(payload)
+    result = executor.call(
+        'serial:%s' % options['port'], serial_do_transaction, options,
+        payload.get('steps') or [], payload.get('encoding', 'latin-1'))
+    return jsonrpc.response(result)
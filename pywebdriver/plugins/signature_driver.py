@@ -24,7 +24,6 @@ import logging
 import os
 
 from flask_cors import cross_origin
-from flask import request, make_response, jsonify
 
 try:
     import pymtp
@@ -33,12 +32,19 @@ except ImportError:
 
 
 from pywebdriver import app, config, drivers
+from pywebdriver import jsonrpc
+from .base_driver import executor
 
 
 @app.route('/hw_proxy/get_signature', methods=['GET'])
 @cross_origin()
 def get_signature_http():
+    return jsonrpc.response(executor.call('signature', get_signature))
 
+
+def get_signature():
+    """ Download the signature file from the MTP device and return its
+    content (None if it is missing) """
     file_ = None
     data = None
 
@@ -52,7 +58,7 @@ def get_signature_http():
         mtp.connect()
     except Exception, err:
         app.logger.error('Unable to connect device %s' % str(err))
-        return jsonify(jsonrpc='2.0', result=data)
+        return data
 
     for f in mtp.get_filelisting():
         if f.filename == signature_file:
@@ -73,4 +79,4 @@ def get_signature_http():
         app.logger.error('file not found on the device: %s' % signature_file)
 
     mtp.disconnect()
-    return jsonify(jsonrpc='2.0', result=data)
+    return data
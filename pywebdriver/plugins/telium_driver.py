@@ -20,22 +20,160 @@
 ###############################################################################
 
 from pywebdriver import app, config, drivers
+from pywebdriver import capture
+from pywebdriver import events
+from pywebdriver import jsonrpc
+from pywebdriver import lanes
 from flask_cors import cross_origin
-from flask import request, jsonify, render_template
-from base_driver import ThreadDriver, check
-import simplejson
+from flask import request, render_template
+from base_driver import DriverBusy, ThreadDriver, check
+from virtual_device import VirtualTelium, is_virtual, virtual_option
+from collections import OrderedDict
+from threading import Condition, Thread
 import pypostelium
 import simplejson as json
+import sys
+import time
+import uuid
 from datetime import datetime
 
 class TeliumDriver(ThreadDriver, pypostelium.Driver):
-    """ Telium Driver class for pywebdriver """
+    """ Telium Driver class for pywebdriver
+
+    A transaction goes through the states 'started' (queued),
+    'awaiting_card' (sent to the terminal) and then one of the final states
+    'approved', 'declined', 'timeout' or 'error'. """
+
+    event_source = 'telium'
+    final_states = ('approved', 'declined', 'timeout', 'error')
+    # Number of transactions kept to answer the result requests
+    transaction_history = 50
+    # Maximum time (in seconds) spent in the 'started' state
+    pending_timeout = 30
+    # Maximum time (in seconds) spent in the 'awaiting_card' state
+    card_timeout = 120
+    # A transaction blocks its worker until the card is presented
+    shared_runtime = False
 
     def __init__(self, *args, **kwargs):
         ThreadDriver.__init__(self)
         pypostelium.Driver.__init__(self, *args, **kwargs)
         # TODO : FIXME : Remove once 'status-posdisplay' branch is merged
         self.vendor_product = None
+        self.transactions = OrderedDict()
+        self.transaction_condition = Condition()
+        self.last_answer = None
+
+    def start_transaction(self, payment_info):
+        """ Queue a payment transaction and return it without waiting
+        for the terminal """
+        transaction = {
+            'transaction_id': uuid.uuid4().hex,
+            'state': 'started',
+            'payment_info': payment_info,
+            'created': time.time(),
+            'timings': {'started': 0.0},
+            'answer': None,
+            'message': None,
+        }
+        with self.transaction_condition:
+            self.transactions[transaction['transaction_id']] = transaction
+            while len(self.transactions) > self.transaction_history:
+                self.transactions.popitem(last=False)
+        try:
+            self.push_task(
+                'process_transaction', transaction['transaction_id'])
+        except DriverBusy:
+            with self.transaction_condition:
+                self.transactions.pop(transaction['transaction_id'], None)
+            raise
+        events.bus.publish('payment', dict(transaction))
+        return dict(transaction)
+
+    def _set_transaction_state(self, transaction, state, **values):
+        with self.transaction_condition:
+            transaction.update(values)
+            transaction['state'] = state
+            transaction['timings'][state] = round(
+                time.time() - transaction['created'], 3)
+            self.transaction_condition.notify_all()
+        events.bus.publish('payment', dict(transaction))
+
+    def get_answer_from_terminal(self, data):
+        self.last_answer = pypostelium.Driver.get_answer_from_terminal(
+            self, data)
+        return self.last_answer
+
+    def process_transaction(self, transaction_id):
+        transaction = self.transactions.get(transaction_id)
+        if not transaction:
+            return
+        if time.time() - transaction['created'] > self.pending_timeout:
+            self._set_transaction_state(
+                transaction, 'timeout',
+                message='Not sent to the terminal after %is' % (
+                    self.pending_timeout))
+            return
+
+        self.last_answer = None
+        self._set_transaction_state(transaction, 'awaiting_card')
+        result = {}
+        task = capture.get_task()
+
+        def dialog():
+            capture.set_task(*task)
+            result['sent'] = self.transaction_start(
+                transaction['payment_info'])
+
+        worker = Thread(target=dialog)
+        worker.daemon = True
+        worker.start()
+        worker.join(self.card_timeout)
+        if worker.is_alive():
+            # Abort the dialog by closing the port used by the worker
+            if self.serial:
+                self.serial.close()
+            worker.join(5)
+            self._set_transaction_state(
+                transaction, 'timeout',
+                message='No answer from the terminal after %is' % (
+                    self.card_timeout))
+            return
+
+        answer = self.last_answer
+        if answer:
+            if answer['transaction_result'] == '0':
+                state = 'approved'
+            else:
+                state = 'declined'
+            self._set_transaction_state(transaction, state, answer=answer)
+        elif result.get('sent'):
+            self._set_transaction_state(
+                transaction, 'timeout',
+                message='The terminal did not send the transaction result')
+        else:
+            self._set_transaction_state(
+                transaction, 'error',
+                message='The terminal did not accept the transaction')
+
+    def reset_device(self):
+        if self.serial:
+            self.serial.close()
+
+    def wait_transaction(self, transaction_id, state=None, timeout=30):
+        """ Wait until the transaction reaches a final state, or leaves
+        `state` if given, and return it (long polling) """
+        deadline = time.time() + timeout
+        with self.transaction_condition:
+            transaction = self.transactions.get(transaction_id)
+            while transaction and \
+                    transaction['state'] not in self.final_states and \
+                    (state is None or transaction['state'] == state):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.transaction_condition.wait(remaining)
+            return transaction and dict(transaction)
 
     def get_payment_info_from_price(self, price, payment_mode):
         return {
@@ -58,16 +196,50 @@ class TeliumDriver(ThreadDriver, pypostelium.Driver):
             self.vendor_product = False
         return self.status
 
-driver_config = {}
-if config.get('telium_driver', 'device_name'):
-    driver_config['telium_terminal_device_name'] =\
-        config.get('telium_driver', 'device_name')
-if config.getint('telium_driver', 'device_rate'):
-    driver_config['telium_terminal_device_rate'] =\
-        config.getint('telium_driver', 'device_rate')
 
-telium_driver = TeliumDriver(driver_config)
+def get_driver_config(device_name):
+    driver_config = {}
+    if device_name:
+        driver_config['telium_terminal_device_name'] = device_name
+    if config.getint('telium_driver', 'device_rate'):
+        driver_config['telium_terminal_device_rate'] =\
+            config.getint('telium_driver', 'device_rate')
+    if is_virtual('telium_driver'):
+        virtual_telium = VirtualTelium(
+            'telium_driver',
+            baudrate=config.getint('telium_driver', 'device_rate') or 9600,
+            processing_time=virtual_option(
+                'telium_driver', 'processing_time', 2.0),
+            transaction_result=virtual_option(
+                'telium_driver', 'transaction_result', '0'),
+        )
+        driver_config['telium_terminal_device_name'] = virtual_telium.path
+    return driver_config
+
+# The terminal I/O is captured through the Serial class of pypostelium
+telium_module = sys.modules[pypostelium.Driver.__module__]
+telium_module.Serial = capture.serial_class(telium_module.Serial, 'telium')
+
+# 10 bits per byte on the serial line
+if config.getint('telium_driver', 'device_rate'):
+    TeliumDriver.link_rate = config.getint(
+        'telium_driver', 'device_rate') / 10.0
+TeliumDriver.configure('telium_driver')
+if config.has_option('telium_driver', 'pending_timeout'):
+    TeliumDriver.pending_timeout = config.getfloat(
+        'telium_driver', 'pending_timeout')
+if config.has_option('telium_driver', 'card_timeout'):
+    TeliumDriver.card_timeout = config.getfloat(
+        'telium_driver', 'card_timeout')
+telium_driver = TeliumDriver(
+    get_driver_config(config.get('telium_driver', 'device_name')))
 drivers['telium'] = telium_driver
+for lane, section in lanes.get_sections():
+    device_name = lanes.get_option(section, 'telium_device')
+    if device_name or is_virtual('telium_driver'):
+        lane_driver = TeliumDriver(get_driver_config(device_name))
+        lane_driver.device_key = lane
+        lanes.register(lane, 'telium', lane_driver)
 
 
 @app.route(
@@ -76,20 +248,38 @@ drivers['telium'] = telium_driver
 @cross_origin(headers=['Content-Type'])
 def payment_terminal_transaction_start():
     app.logger.debug('Telium: Call payment_terminal_transaction_start')
-    payment_info = request.json['params']['payment_info']
+    payment_info = jsonrpc.get_params()['payment_info']
     app.logger.debug('Telium: payment_info=%s', payment_info)
-    telium_driver.push_task('transaction_start', payment_info)
-    return jsonify(jsonrpc='2.0', result=True)
+    transaction = lanes.get_driver('telium').start_transaction(payment_info)
+    return jsonrpc.response({
+        'transaction_id': transaction['transaction_id'],
+        'state': transaction['state'],
+    })
+
+
+@app.route(
+    '/hw_proxy/payment_terminal_transaction_result',
+    methods=['POST', 'GET', 'PUT', 'OPTIONS'])
+@cross_origin(headers=['Content-Type'])
+def payment_terminal_transaction_result():
+    """ Long polling: answer when the transaction is finished, when it
+    leaves the given state, or after timeout seconds (60 at most) """
+    params = jsonrpc.get_params()
+    transaction = lanes.get_driver('telium').wait_transaction(
+        params['transaction_id'],
+        state=params.get('state'),
+        timeout=min(float(params.get('timeout', 30)), 60))
+    return jsonrpc.response(transaction or False)
 
 
 @app.route('/telium_status.html', methods=['POST'])
 @cross_origin()
 def telium_status():
-    info = telium_driver.get_payment_info_from_price(
+    driver = lanes.get_driver('telium')
+    info = driver.get_payment_info_from_price(
         float(request.values['price']),
         request.values['payment_mode'])
     app.logger.debug('Telium status info=%s', info)
-    telium_driver.push_task('transaction_start', json.dumps(
-        info, sort_keys=True))
+    driver.start_transaction(json.dumps(info, sort_keys=True))
     return render_template('telium_status.html')
 
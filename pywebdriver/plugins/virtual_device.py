@@ -0,0 +1,497 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""Virtual devices, used when a driver section of the config file contains
+mode=virtual. They replace the hardware by emulators that decode the byte
+stream and model the transfer rate of the real link, so that capacity
+tests can be done on any linux box."""
+
+import array
+import os
+import pty
+import threading
+import time
+import tty
+from collections import deque
+
+from pywebdriver import app, config
+
+ENQ = '\x05'
+ACK = '\x06'
+EOT = '\x04'
+STX = '\x02'
+ETX = '\x03'
+
+ESCPOS_CODEPAGES = {
+    0: 'cp437',
+    2: 'cp850',
+    3: 'cp860',
+    4: 'cp863',
+    5: 'cp865',
+    16: 'cp1252',
+    17: 'cp866',
+    18: 'cp852',
+    19: 'cp858',
+    39: 'iso8859_2',
+    40: 'iso8859_9',
+    48: 'cp1254',
+}
+
+
+def is_virtual(section):
+    return config.has_option(section, 'mode') and \
+        config.get(section, 'mode') == 'virtual'
+
+
+def virtual_option(section, option, default):
+    """ Return the option 'virtual_<option>' of the section, converted to
+    the type of the default value """
+    option = 'virtual_%s' % option
+    if not config.has_option(section, option):
+        return default
+    return type(default)(config.get(section, option))
+
+
+class VirtualSerialDevice(object):
+    """ Emulate a device connected on a serial line.
+
+    A pty pair is created: the driver uses the slave path as its serial
+    port, the emulator reads the master side at the modeled rate
+    (1 start bit, 8 data bits, 1 stop bit per byte) and answers through
+    reply()."""
+
+    def __init__(self, name, baudrate=9600):
+        self.name = name
+        self.baudrate = baudrate
+        self.received = 0
+        self.sent = 0
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.thread = threading.Thread(
+            target=self._run, name='virtual-%s' % name)
+        self.thread.daemon = True
+        self.thread.start()
+        app.logger.info('Virtual device %s on %s', name, self.path)
+
+    def transfer_time(self, size):
+        return size * 10.0 / self.baudrate
+
+    def _run(self):
+        while True:
+            try:
+                data = os.read(self.master, 64)
+            except OSError:
+                time.sleep(0.05)
+                continue
+            time.sleep(self.transfer_time(len(data)))
+            self.received += len(data)
+            try:
+                self.receive(data)
+            except Exception:
+                app.logger.exception('Virtual device %s failed', self.name)
+
+    def reply(self, data):
+        for i in range(0, len(data), 16):
+            chunk = data[i:i + 16]
+            time.sleep(self.transfer_time(len(chunk)))
+            os.write(self.master, chunk)
+        self.sent += len(data)
+
+    def receive(self, data):
+        """ Called with the bytes sent by the driver """
+
+    def get_status(self):
+        return {
+            'status': 'connected',
+            'messages': ['Virtual device on %s (%i bytes received)' % (
+                self.path, self.received)],
+        }
+
+
+class VirtualSerialPort(VirtualSerialDevice):
+    """ Generic serial peripheral: each received line is answered by
+    `answer`, or echoed back if no answer is defined """
+
+    def __init__(self, name, baudrate=9600, answer=None):
+        self.answer = answer
+        self.buffer = ''
+        self.lines = deque(maxlen=100)
+        super(VirtualSerialPort, self).__init__(name, baudrate=baudrate)
+
+    def receive(self, data):
+        self.buffer += data.replace('\r', '\n')
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            if not line:
+                continue
+            self.lines.append(line)
+            self.reply((self.answer or line) + '\r\n')
+
+
+class VirtualDisplay(VirtualSerialDevice):
+    """ Customer display understanding the Bixolon / Epson command set """
+
+    def __init__(self, name, baudrate=9600, rows=2, cols=20):
+        self.rows = rows
+        self.cols = cols
+        self.pending = ''
+        self.clear()
+        super(VirtualDisplay, self).__init__(name, baudrate=baudrate)
+
+    def clear(self):
+        self.screen = [[' '] * self.cols for i in range(self.rows)]
+        self.row = 0
+        self.col = 0
+
+    def _put(self, char):
+        if self.row < self.rows and self.col < self.cols:
+            self.screen[self.row][self.col] = char
+        self.col += 1
+
+    def receive(self, data):
+        data = self.pending + data
+        self.pending = ''
+        i = 0
+        while i < len(data):
+            char = data[i]
+            if char == '\x1f':
+                if i + 1 >= len(data):
+                    self.pending = data[i:]
+                    return
+                if data[i + 1] == '\x24':
+                    # Move cursor (column and row start at 1)
+                    if i + 3 >= len(data):
+                        self.pending = data[i:]
+                        return
+                    self.col = ord(data[i + 2]) - 1
+                    self.row = ord(data[i + 3]) - 1
+                    i += 4
+                elif data[i + 1] == '\x43':
+                    # Cursor display on / off
+                    i += 3
+                else:
+                    i += 2
+                continue
+            elif char == '\x1b':
+                i += 2
+                continue
+            elif char == '\x0c':
+                self.clear()
+            elif char == '\n':
+                self.row += 1
+            elif char == '\r':
+                self.col = 0
+            elif char >= ' ':
+                self._put(char)
+            i += 1
+
+    def get_lines(self):
+        return [''.join(line) for line in self.screen]
+
+    def get_status(self):
+        status = super(VirtualDisplay, self).get_status()
+        status['messages'] += self.get_lines()
+        return status
+
+
+class VirtualTelium(VirtualSerialDevice):
+    """ Payment terminal speaking the Telium protocol E+.
+    The transaction is answered after `processing_time` seconds (time for
+    the customer to insert its card and type its pin code) with
+    `transaction_result` ('0' means accepted)."""
+
+    def __init__(self, name, baudrate=9600, processing_time=2.0,
+                 transaction_result='0'):
+        self.processing_time = processing_time
+        self.transaction_result = transaction_result
+        self.state = 'idle'
+        self.buffer = ''
+        self.request = None
+        super(VirtualTelium, self).__init__(name, baudrate=baudrate)
+
+    def lrc(self, message):
+        lrc = 0
+        for char in message:
+            lrc ^= ord(char)
+        return chr(lrc)
+
+    def _answer(self):
+        self.state = 'wait_answer_ack'
+        self.reply(ENQ)
+
+    def receive(self, data):
+        self.buffer += data
+        while self.buffer:
+            if self.state == 'wait_message' and self.buffer[0] == STX:
+                end = self.buffer.find(ETX)
+                if end == -1 or len(self.buffer) < end + 2:
+                    return
+                self.request = self.buffer[1:end]
+                self.buffer = self.buffer[end + 2:]
+                self.state = 'wait_eot'
+                self.reply(ACK)
+                continue
+            char, self.buffer = self.buffer[0], self.buffer[1:]
+            if char == ENQ and self.state in ('idle', 'wait_message'):
+                self.state = 'wait_message'
+                self.reply(ACK)
+            elif char == EOT and self.state == 'wait_eot':
+                self.state = 'processing'
+                timer = threading.Timer(self.processing_time, self._answer)
+                timer.daemon = True
+                timer.start()
+            elif char == ACK and self.state == 'wait_answer_ack':
+                request = self.request
+                message = (
+                    request[0:2] + self.transaction_result +
+                    request[2:10] + request[11] + request[13:16] +
+                    request[16:26] + ETX)
+                self.state = 'wait_final_ack'
+                self.reply(STX + message + self.lrc(message))
+            elif char == ACK and self.state == 'wait_final_ack':
+                self.state = 'idle'
+                self.reply(EOT)
+            elif char == EOT:
+                self.state = 'idle'
+
+
+class EscPosDecoder(object):
+    """ Decode an ESC/POS byte stream into a text rendering of the
+    receipts. Raster images are rendered with one character per 8x8 dots
+    block. """
+
+    # Number of parameter bytes of the fixed length commands
+    ESC_PARAMS = {
+        '@': 0, '2': 0, '<': 0, '!': 1, '-': 1, '3': 1, 'E': 1, 'G': 1,
+        'J': 1, 'M': 1, 'R': 1, 'a': 1, 'c': 2, 'd': 1, 'p': 3, 'r': 1,
+        't': 1, '{': 1, 'V': 1,
+    }
+    GS_PARAMS = {
+        '!': 1, 'B': 1, 'H': 1, 'L': 2, 'W': 2, 'f': 1, 'h': 1, 'w': 1,
+        'a': 1, 'r': 1,
+    }
+
+    def __init__(self, history=20, on_status_request=None):
+        self.receipts = deque(maxlen=history)
+        self.lines = []
+        self.line = []
+        self.pending = ''
+        self.codepage = 'cp437'
+        self.cuts = 0
+        self.drawer_kicks = 0
+        self.on_status_request = on_status_request
+
+    def feed(self, data):
+        data = self.pending + data
+        self.pending = ''
+        i = 0
+        while i < len(data):
+            size = self._parse(data, i)
+            if size is None:
+                self.pending = data[i:]
+                return
+            i += size
+
+    def _parse(self, data, i):
+        """ Handle the command starting at i and return its length, or
+        None if the command is not complete yet """
+        char = data[i]
+        remaining = len(data) - i
+        if char == '\x1b':
+            if remaining < 2:
+                return None
+            size = 2 + self.ESC_PARAMS.get(data[i + 1], 0)
+            if remaining < size:
+                return None
+            if data[i + 1] == 't':
+                self.codepage = ESCPOS_CODEPAGES.get(
+                    ord(data[i + 2]), 'cp437')
+            elif data[i + 1] == 'p':
+                self.drawer_kicks += 1
+            elif data[i + 1] == 'd':
+                self._newline(ord(data[i + 2]))
+            return size
+        elif char == '\x1d':
+            if remaining < 2:
+                return None
+            command = data[i + 1]
+            if command == 'V':
+                if remaining < 3:
+                    return None
+                size = 4 if ord(data[i + 2]) in (65, 66) else 3
+                if remaining < size:
+                    return None
+                self.cut()
+                return size
+            elif command == 'v':
+                if remaining < 8:
+                    return None
+                width = ord(data[i + 4]) + ord(data[i + 5]) * 256
+                height = ord(data[i + 6]) + ord(data[i + 7]) * 256
+                size = 8 + width * height
+                if remaining < size:
+                    return None
+                self._raster(data[i + 8:i + size], width, height)
+                return size
+            elif command == 'k':
+                if remaining < 3:
+                    return None
+                if ord(data[i + 2]) <= 6:
+                    end = data.find('\x00', i + 3)
+                    if end == -1:
+                        return None
+                    self._text('|||| %s ||||' % data[i + 3:end])
+                    self._newline()
+                    return end - i + 1
+                if remaining < 4:
+                    return None
+                size = 4 + ord(data[i + 3])
+                if remaining < size:
+                    return None
+                self._text('|||| %s ||||' % data[i + 4:i + size])
+                self._newline()
+                return size
+            size = 2 + self.GS_PARAMS.get(command, 0)
+            return size if remaining >= size else None
+        elif char == '\x10':
+            if remaining < 3:
+                return None
+            if data[i + 1] == '\x04' and self.on_status_request:
+                self.on_status_request(ord(data[i + 2]))
+            return 3
+        elif char == '\n':
+            self._newline()
+        elif char >= ' ':
+            self._text(char)
+        return 1
+
+    def _text(self, text):
+        self.line.append(text.decode(self.codepage, 'replace'))
+
+    def _newline(self, count=1):
+        for i in range(count):
+            self.lines.append(u''.join(self.line))
+            self.line = []
+
+    def _raster(self, data, width, height):
+        if self.line:
+            self._newline()
+        for top in range(0, height, 8):
+            rendered = []
+            for x in range(width):
+                dots = 0
+                for y in range(top, min(top + 8, height)):
+                    dots += bin(ord(data[y * width + x])).count('1')
+                rendered.append(u'#' if dots >= 16 else u' ')
+            self.lines.append(u''.join(rendered))
+
+    def cut(self):
+        if self.line:
+            self._newline()
+        self.receipts.append(u'\n'.join(self.lines).rstrip('\n'))
+        self.lines = []
+        self.cuts += 1
+
+
+class VirtualUsbPrinter(object):
+    """ Emulate an ESC/POS printer connected on USB, exposing the subset
+    of the pyusb device API used by the xmlescpos library.
+
+    The link is modeled as USB full-speed bulk transfers: each transfer
+    costs `transfer_overhead` seconds (scheduling in the next frame) plus
+    the time to send its packets at `usb_rate` bytes/s. The printer has a
+    receive buffer of `buffer_size` bytes emptied at `print_rate` bytes/s:
+    a write stalls while the buffer is full."""
+
+    def __init__(self, usb_rate=1000000, buffer_size=4096, print_rate=6000,
+                 max_packet_size=64, transfer_overhead=0.001):
+        self.usb_rate = usb_rate
+        self.buffer_size = buffer_size
+        self.print_rate = print_rate
+        self.max_packet_size = max_packet_size
+        self.transfer_overhead = transfer_overhead
+        self.paper_out = False
+        self.lock = threading.Lock()
+        self.busy_until = time.time()
+        self.responses = deque()
+        self.written = 0
+        self.transfers = 0
+        self.stalled = 0.0
+        self.decoder = EscPosDecoder(on_status_request=self._status_request)
+
+    def _status_request(self, request):
+        if request == 1:
+            response = 0x1a if self.paper_out else 0x12
+        elif request == 4:
+            response = 0x72 if self.paper_out else 0x12
+        else:
+            response = 0x12
+        self.responses.append(response)
+
+    def transfer_time(self, size):
+        packets = (size + self.max_packet_size - 1) / self.max_packet_size
+        return self.transfer_overhead + \
+            packets * self.max_packet_size / float(self.usb_rate)
+
+    def write(self, endpoint, data, interface=None, timeout=None):
+        if isinstance(data, array.array):
+            data = data.tostring()
+        with self.lock:
+            now = time.time()
+            level = max(0.0, (self.busy_until - now) * self.print_rate)
+            stall = max(
+                0.0, (level + len(data) - self.buffer_size) / self.print_rate)
+            delay = stall + self.transfer_time(len(data))
+            self.busy_until = max(now, self.busy_until) + \
+                len(data) / float(self.print_rate)
+            self.stalled += stall
+            self.written += len(data)
+            self.transfers += 1
+            time.sleep(delay)
+            self.decoder.feed(data)
+        return len(data)
+
+    def read(self, endpoint, size, interface=None, timeout=None):
+        response = []
+        while self.responses and len(response) < size:
+            response.append(self.responses.popleft())
+        return array.array('B', response)
+
+    def is_kernel_driver_active(self, interface):
+        return False
+
+    def detach_kernel_driver(self, interface):
+        pass
+
+    def set_configuration(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def get_status(self):
+        return {
+            'status': 'connected',
+            'messages': [
+                'Virtual printer: %i bytes in %i transfers, %i receipts, '
+                '%.2fs stalled' % (
+                    self.written, self.transfers, self.decoder.cuts,
+                    self.stalled)],
+        }
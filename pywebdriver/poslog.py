@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""Log messages of the POS (/hw_proxy/log).
+
+The messages are queued in memory and written in batches by a background
+thread, to stdout, to a rotating file or to journald ([pos_log] output).
+When the queue is full, the new messages are dropped and counted: the
+number of dropped messages is written before the next batch.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from pywebdriver import app, config
+
+try:
+    from systemd import journal
+except ImportError:
+    journal = None
+
+output = 'stdout'
+if config.has_option('pos_log', 'output'):
+    output = config.get('pos_log', 'output')
+
+queue_size = 10000
+if config.has_option('pos_log', 'queue_size'):
+    queue_size = config.getint('pos_log', 'queue_size')
+
+
+def format_message(arguments):
+    return u' '.join(
+        value if isinstance(value, unicode) else str(value).decode(
+            'utf-8', 'replace')
+        for value in arguments)
+
+
+class StreamWriter(object):
+    """ Write the messages to stdout, as print did """
+
+    def write(self, records):
+        sys.stdout.write(''.join(
+            format_message(arguments).encode('utf-8') + '\n'
+            for timestamp, arguments in records))
+        sys.stdout.flush()
+
+
+class FileWriter(object):
+    """ Append the messages to a file, renamed to path.1 (path.1 to
+    path.2, ...) when it exceeds max_bytes """
+
+    def __init__(self, path, max_bytes=10485760, backup_count=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.file = open(path, 'a')
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = '%s.%i' % (self.path, index)
+            if os.path.exists(source):
+                os.rename(source, '%s.%i' % (self.path, index + 1))
+        if self.backup_count:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'a')
+
+    def write(self, records):
+        self.file.write(''.join(
+            '%s %s\n' % (
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+                format_message(arguments).encode('utf-8'))
+            for timestamp, arguments in records))
+        self.file.flush()
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+
+class JournalWriter(object):
+    """ Send the messages to journald (python-systemd is required) """
+
+    def write(self, records):
+        for timestamp, arguments in records:
+            journal.send(
+                format_message(arguments), SYSLOG_IDENTIFIER='pywebdriver-pos')
+
+
+class LogSink(object):
+    """ Bounded queue of messages written in batches of batch_size at most
+    by a background thread """
+
+    batch_size = 500
+
+    def __init__(self, writer, queue_size=10000):
+        self.writer = writer
+        self.queue_size = queue_size
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.written = 0
+        self.dropped = 0
+        # Dropped messages not reported in the output yet
+        self.unreported = 0
+
+    def push(self, arguments):
+        """ Queue a message, return False if it is dropped """
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name='pos-log')
+                self.thread.daemon = True
+                self.thread.start()
+            if len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                self.unreported += 1
+                return False
+            self.queue.append((time.time(), arguments))
+            self.condition.notify()
+            return True
+
+    def _take(self):
+        """ Wait for messages and return the next batch, with the number of
+        messages it contains """
+        with self.condition:
+            # No timeout: a timed wait polls every 50ms at most
+            while not self.queue:
+                self.condition.wait()
+            records = []
+            while self.queue and len(records) < self.batch_size:
+                records.append(self.queue.popleft())
+            count = len(records)
+            if self.unreported:
+                records.insert(0, (time.time(), [
+                    'pywebdriver: %i POS log messages dropped' % (
+                        self.unreported)]))
+                self.unreported = 0
+            return records, count
+
+    def run(self):
+        while True:
+            records, count = self._take()
+            try:
+                self.writer.write(records)
+                self.written += count
+            except Exception as e:
+                app.logger.error('Unable to write the POS log: %s', e)
+                with self.condition:
+                    self.dropped += count
+                    self.unreported += count
+
+
+if output == 'file':
+    file_options = {}
+    for option in ('max_bytes', 'backup_count'):
+        if config.has_option('pos_log', option):
+            file_options[option] = config.getint('pos_log', option)
+    writer = FileWriter(config.get('pos_log', 'file'), **file_options)
+elif output == 'journald' and journal is not None:
+    writer = JournalWriter()
+else:
+    if output != 'stdout':
+        app.logger.error(
+            'POS log output %s not available, stdout is used', output)
+    writer = StreamWriter()
+
+sink = LogSink(writer, queue_size=queue_size)
+
+
+def push(arguments):
+    return sink.push(arguments)
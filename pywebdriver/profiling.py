@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""On-demand CPU profiling of the requests and of the driver tasks.
+
+A session either profiles with cProfile the next N requests and/or driver
+tasks (or all of them during a time window), or samples the stacks of all
+the threads during a time window. The result is written as a pstats file
+or as collapsed stacks (flamegraph.pl, speedscope) and can be downloaded.
+When no session is running, the only cost is the test of `active`.
+"""
+
+import cProfile
+import hmac
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from flask import request, send_file
+
+from pywebdriver import app, config
+from pywebdriver import jsonrpc
+
+output_dir = tempfile.gettempdir()
+if config.has_option('profiling', 'output_dir'):
+    output_dir = config.get('profiling', 'output_dir')
+
+# Without a token, the profiling is only allowed from the machine itself
+token = None
+if config.has_option('profiling', 'token'):
+    token = config.get('profiling', 'token') or None
+LOOPBACK = ('127.0.0.1', '::1', '::ffff:127.0.0.1')
+
+# True while a cProfile session profiles the requests and the tasks
+active = False
+session = None
+lock = threading.RLock()
+
+
+class ProfilingSession(object):
+
+    def __init__(self, mode='cprofile', requests=0, tasks=0, duration=None,
+                 interval=0.005):
+        self.mode = mode
+        self.limits = {'request': requests, 'task': tasks}
+        self.counts = {'request': 0, 'task': 0}
+        self.duration = duration
+        self.interval = interval
+        self.state = 'running'
+        self.started = time.time()
+        self.running = 0
+        self.stats = None
+        self.samples = Counter()
+        self.path = None
+        self.timer = None
+
+    def start(self):
+        if self.mode == 'sampling':
+            thread = threading.Thread(target=self._sample)
+            thread.daemon = True
+            thread.start()
+        elif self.duration:
+            self.timer = threading.Timer(self.duration, self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def take(self, kind):
+        """ Return True if this request or task has to be profiled """
+        with lock:
+            if self.state != 'running' or self.mode != 'cprofile':
+                return False
+            limit = self.limits[kind]
+            if limit and self.counts[kind] >= limit or \
+                    not limit and not self.duration:
+                return False
+            self.counts[kind] += 1
+            self.running += 1
+            return True
+
+    def add(self, profile):
+        with lock:
+            self.running -= 1
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            if self.state == 'running' and not self.duration and all(
+                    self.counts[kind] >= limit
+                    for kind, limit in self.limits.items()):
+                self.state = 'stopping'
+            if self.state == 'stopping' and not self.running:
+                self._write()
+
+    def stop(self):
+        with lock:
+            if self.state == 'running':
+                self.state = 'stopping'
+                if self.timer:
+                    self.timer.cancel()
+            # The sampling thread writes its own result when it ends
+            if self.state == 'stopping' and not self.running and \
+                    self.mode != 'sampling':
+                self._write()
+
+    def _sample(self):
+        own = threading.current_thread().ident
+        deadline = time.time() + (self.duration or 10)
+        while self.state == 'running' and time.time() < deadline:
+            names = dict(
+                (thread.ident, thread.name)
+                for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%i)' % (
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        with lock:
+            self._write()
+
+    def _write(self):
+        """ Called under lock. A session replaced by a newer one may end
+        after it: the newer one keeps `active` """
+        global active
+        self.state = 'done'
+        if session is self:
+            active = False
+        name = 'pywebdriver-%s' % time.strftime(
+            '%Y%m%d-%H%M%S', time.localtime(self.started))
+        if self.mode == 'sampling' and self.samples:
+            self.path = os.path.join(output_dir, name + '.collapsed')
+            with open(self.path, 'w') as output:
+                for stack, count in sorted(self.samples.items()):
+                    output.write('%s %i\n' % (stack, count))
+        elif self.stats is not None:
+            self.path = os.path.join(output_dir, name + '.pstats')
+            self.stats.dump_stats(self.path)
+
+    def get_status(self):
+        return {
+            'mode': self.mode,
+            'state': self.state,
+            'started': self.started,
+            'duration': self.duration,
+            'limits': self.limits,
+            'profiled': self.counts,
+            'samples': sum(self.samples.values()),
+            'path': self.path,
+        }
+
+
+def start(**kwargs):
+    global active, session
+    with lock:
+        if session:
+            session.stop()
+        session = ProfilingSession(**kwargs)
+        active = session.mode == 'cprofile'
+        session.start()
+    return session
+
+
+def run(kind, func, *args):
+    """ Call func, profiling it if the running session asks for it """
+    current = session
+    if current is None or not current.take(kind):
+        return func(*args)
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        current.add(profile)
+
+
+class ProfilerMiddleware(object):
+    """ Profile the requests (the whole Flask dispatch) """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if active and not environ.get('PATH_INFO', '').startswith(
+                '/admin/profile'):
+            return run('request', self.wsgi_app, environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+
+app.wsgi_app = ProfilerMiddleware(app.wsgi_app)
+
+
+def admin_only(func):
+    """ Deny the requests of other machines, or without the token when one
+    is configured (X-Profiling-Token header or token argument) """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if token:
+            given = request.headers.get('X-Profiling-Token') or \
+                request.args.get('token') or ''
+            allowed = hmac.compare_digest(str(given), str(token))
+        else:
+            allowed = request.remote_addr in LOOPBACK
+        if not allowed:
+            return jsonrpc.response(False, status=403)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@app.route('/admin/profile/start', methods=['POST', 'GET', 'PUT', 'OPTIONS'])
+@admin_only
+def profile_start():
+    """ Params: mode (cprofile or sampling), requests and tasks (number of
+    requests and driver tasks to profile), duration (seconds), interval
+    (sampling period in seconds) """
+    params = dict(jsonrpc.get_params(), **request.args.to_dict())
+    mode = params.get('mode', 'cprofile')
+    if mode not in ('cprofile', 'sampling'):
+        return jsonrpc.response(False)
+    duration = params.get('duration')
+    duration = duration and float(duration)
+    requests = int(params.get('requests', 0))
+    tasks = int(params.get('tasks', 0))
+    # Without a number of requests or tasks nor a duration, the session
+    # would never profile anything nor end
+    if mode == 'cprofile' and not (requests or tasks or duration):
+        return jsonrpc.response(False)
+    current = start(
+        mode=mode, requests=requests, tasks=tasks, duration=duration,
+        interval=float(params.get('interval', 0.005)))
+    return jsonrpc.response(current.get_status())
+
+
+@app.route('/admin/profile/stop', methods=['POST', 'GET', 'PUT', 'OPTIONS'])
+@admin_only
+def profile_stop():
+    if session:
+        session.stop()
+    return jsonrpc.response(session and session.get_status())
+
+
+@app.route('/admin/profile/status', methods=['POST', 'GET', 'PUT', 'OPTIONS'])
+@admin_only
+def profile_status():
+    return jsonrpc.response(session and session.get_status())
+
+
+@app.route('/admin/profile/download', methods=['GET'])
+@admin_only
+def profile_download():
+    if not session or not session.path:
+        return jsonrpc.response(False, status=404)
+    return send_file(session.path, as_attachment=True)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014 Akretion (http://www.akretion.com).
+#   @author Sylvain LE GAL (https://twitter.com/legalsylvain)
+#   @author Sébastien BEAU <sebastien.beau@akretion.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Request handler of the development server used by pywebdriverd."""
+
+import socket
+
+from werkzeug.serving import WSGIRequestHandler
+
+
+class RequestHandler(WSGIRequestHandler):
+    """ HTTP/1.1 handler: the POS keeps its connection open between the
+    calls instead of opening a new one for each request """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        WSGIRequestHandler.setup(self)
+        # The headers and the body of the answers are written separately,
+        # Nagle's algorithm would delay the body until the client ack
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
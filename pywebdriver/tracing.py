@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""Tracing of the requests down to the device.
+
+A trace is started for each API request and carried with the queued task
+to the driver thread. The spans (parse, enqueue, queue_wait, task, render,
+transfer, cut, ...) are recorded in the trace of the current thread. The
+last traces are kept in memory (/hw_proxy/traces) and can be appended to
+an OTLP/JSON file ([tracing] export_file).
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+from flask import request
+
+from pywebdriver import app, config
+
+enabled = True
+if config.has_option('tracing', 'enabled'):
+    enabled = config.getboolean('tracing', 'enabled')
+
+history = 100
+if config.has_option('tracing', 'history'):
+    history = config.getint('tracing', 'history')
+
+export_file = None
+if config.has_option('tracing', 'export_file'):
+    export_file = config.get('tracing', 'export_file') or None
+
+# Polling and streaming routes are not traced
+exclude = [
+    'hello_http', 'handshake_json', 'status_json', 'job_status_json',
+    'events_http', 'traces_json', 'payment_terminal_transaction_result',
+    'static', 'image_html']
+if config.has_option('tracing', 'exclude'):
+    exclude = config.get('tracing', 'exclude').split()
+
+TRACE_ID = re.compile('^[0-9a-f]{32}$')
+
+traces = deque(maxlen=history)
+lock = threading.Lock()
+local = threading.local()
+
+
+class Trace(object):
+
+    def __init__(self, name, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.name = name
+        self.start = time.time()
+        self.end = None
+        self.spans = []
+        # The request and each queued task hold the trace until they end
+        self.pending = 1
+
+    def add_span(self, name, start, end=None, parent=None, **attributes):
+        span = {
+            'span_id': '%016x' % random.getrandbits(64),
+            'parent': parent,
+            'name': name,
+            'start': start,
+            'end': end,
+            'attributes': dict(
+                (key, value) for key, value in attributes.items()
+                if value is not None),
+        }
+        with lock:
+            self.spans.append(span)
+        return span
+
+    def hold(self):
+        with lock:
+            self.pending += 1
+
+    def release(self):
+        with lock:
+            self.pending -= 1
+            if self.pending:
+                return
+            self.end = max([self.start] + [
+                span['end'] for span in self.spans if span['end']])
+        if export_file:
+            export(self)
+
+    def to_dict(self):
+        with lock:
+            spans = list(self.spans)
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'start': self.start,
+            'complete': self.end is not None,
+            'duration_ms': self.end and (self.end - self.start) * 1000,
+            'spans': [{
+                'span_id': span['span_id'],
+                'parent': span['parent'],
+                'name': span['name'],
+                'offset_ms': (span['start'] - self.start) * 1000,
+                'duration_ms': span['end'] and (
+                    span['end'] - span['start']) * 1000,
+                'attributes': span['attributes'],
+            } for span in spans],
+        }
+
+
+def current():
+    """ Return the trace of the current thread (None if not traced) """
+    return getattr(local, 'trace', None)
+
+
+def activate(trace):
+    local.trace = trace
+    local.parents = []
+
+
+def deactivate():
+    local.trace = None
+    local.parents = []
+
+
+def _parent():
+    return local.parents[-1] if local.parents else None
+
+
+@contextmanager
+def span(name, **attributes):
+    """ Record the enclosed code as a span of the current trace """
+    trace = current()
+    if trace is None:
+        yield None
+        return
+    current_span = trace.add_span(
+        name, time.time(), parent=_parent(), **attributes)
+    local.parents.append(current_span['span_id'])
+    try:
+        yield current_span
+    finally:
+        local.parents.pop()
+        current_span['end'] = time.time()
+
+
+def record(name, start, end, **attributes):
+    """ Record a span that already ended """
+    trace = current()
+    if trace is not None:
+        trace.add_span(name, start, end, parent=_parent(), **attributes)
+
+
+def accumulate(name, start, end, size=0):
+    """ Merge in one span the short operations repeated under the same
+    parent (device writes): the span covers them all, its attributes give
+    their number, their total size and the time really spent in them """
+    trace = current()
+    if trace is None:
+        return
+    parent = _parent()
+    with lock:
+        for existing in reversed(trace.spans):
+            if existing['name'] == name and existing['parent'] == parent:
+                existing['end'] = end
+                attributes = existing['attributes']
+                attributes['count'] += 1
+                attributes['bytes'] += size
+                attributes['busy_ms'] += (end - start) * 1000
+                return
+    trace.add_span(
+        name, start, end, parent=parent,
+        count=1, bytes=size, busy_ms=(end - start) * 1000)
+
+
+def get_traces(limit=20, trace_id=None):
+    """ Return the last traces, the most recent first """
+    with lock:
+        selected = [
+            trace for trace in reversed(traces)
+            if trace_id is None or trace.trace_id == trace_id]
+    return [trace.to_dict() for trace in selected[:limit]]
+
+
+def to_otlp(trace):
+    """ Return the trace as an OTLP/JSON ExportTraceServiceRequest """
+    def attributes(values):
+        result = []
+        for key, value in sorted(values.items()):
+            if isinstance(value, bool):
+                value = {'boolValue': value}
+            elif isinstance(value, (int, long)):
+                value = {'intValue': str(value)}
+            elif isinstance(value, float):
+                value = {'doubleValue': value}
+            else:
+                value = {'stringValue': unicode(value)}
+            result.append({'key': key, 'value': value})
+        return result
+
+    spans = [{
+        'traceId': trace.trace_id,
+        'spanId': span['span_id'],
+        'parentSpanId': span['parent'] or '',
+        'name': span['name'],
+        'kind': 1,
+        'startTimeUnixNano': str(int(span['start'] * 1e9)),
+        'endTimeUnixNano': str(int((span['end'] or trace.end) * 1e9)),
+        'attributes': attributes(span['attributes']),
+    } for span in trace.spans]
+    return {'resourceSpans': [{
+        'resource': {'attributes': attributes(
+            {'service.name': 'pywebdriver'})},
+        'scopeSpans': [{'scope': {'name': 'pywebdriver'}, 'spans': spans}],
+    }]}
+
+
+def export(trace):
+    line = json.dumps(to_otlp(trace), separators=(',', ':'))
+    with lock:
+        with open(export_file, 'a') as output:
+            output.write(line + '\n')
+
+
+def get_trace_id():
+    """ Trace id given by the client (X-Trace-Id or W3C traceparent) """
+    trace_id = request.headers.get('X-Trace-Id', '').lower()
+    if not trace_id:
+        traceparent = request.headers.get('traceparent', '').split('-')
+        trace_id = len(traceparent) == 4 and traceparent[1].lower() or ''
+    return TRACE_ID.match(trace_id) and trace_id or None
+
+
+@app.before_request
+def start_request_trace():
+    deactivate()
+    if not enabled or request.method == 'OPTIONS' or \
+            request.endpoint is None or request.endpoint in exclude:
+        return
+    trace = Trace(request.endpoint, get_trace_id())
+    with lock:
+        traces.append(trace)
+    activate(trace)
+    local.request_span = trace.add_span(
+        'request', trace.start, method=request.method, path=request.path)
+    local.parents.append(local.request_span['span_id'])
+
+
+@app.after_request
+def add_trace_header(response):
+    trace = current()
+    if trace is not None:
+        response.headers['X-Trace-Id'] = trace.trace_id
+    return response
+
+
+@app.teardown_request
+def end_request_trace(exception=None):
+    trace = current()
+    if trace is None:
+        return
+    local.request_span['end'] = time.time()
+    deactivate()
+    trace.release()
@@ -25,11 +25,11 @@ import platform
 import pip
 import os
 
-from flask import render_template
+from flask import render_template, request
 from flask_cors import cross_origin
 from flask.ext.babel import gettext as _
 
-from pywebdriver import app, drivers
+from pywebdriver import app, config, drivers
 
 
 @app.route("/", methods=['GET'])
@@ -103,3 +103,40 @@ def system():
     methods=['POST', 'GET', 'PUT', 'OPTIONS'])
 def image_html(path=None):
     return app.send_static_file(os.path.join('images/', path))
+
+
+# CORS preflight requests are answered before reaching the plugins, and
+# can be cached by the browser for cors_max_age seconds
+cors_max_age = 7200
+if config.has_option('flask', 'cors_max_age'):
+    cors_max_age = config.getint('flask', 'cors_max_age')
+
+cors_allow_headers = 'Content-Type, Idempotency-Key'
+if config.has_option('flask', 'cors_allow_headers'):
+    cors_allow_headers = config.get('flask', 'cors_allow_headers')
+
+
+@app.before_request
+def cors_preflight():
+    if request.method != 'OPTIONS' or request.url_rule is None or \
+            'Access-Control-Request-Method' not in request.headers:
+        return None
+    response = app.make_default_options_response()
+    response.headers['Access-Control-Allow-Origin'] = request.headers.get(
+        'Origin', '*')
+    response.headers['Access-Control-Allow-Methods'] = ', '.join(
+        sorted(request.url_rule.methods))
+    response.headers['Access-Control-Allow-Headers'] = cors_allow_headers
+    if cors_max_age:
+        response.headers['Access-Control-Max-Age'] = str(cors_max_age)
+    response.headers['Vary'] = 'Origin'
+    return response
+
+
+@app.teardown_request
+def exhaust_request(exception=None):
+    # With HTTP/1.1 keep-alive, a request body not read by the route would
+    # be taken for the beginning of the next request of the connection
+    stream = request.stream
+    if hasattr(stream, 'exhaust'):
+        stream.exhaust()
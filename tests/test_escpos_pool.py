@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#   Copyright (C) 2014-TODAY Akretion (http://www.akretion.com).
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+"""Pool of ESC/POS printers, with two virtual printers.
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import tempfile
+import time
+import unittest
+from ConfigParser import ConfigParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RECEIPT = '<receipt>%s</receipt>' % ('<div>Test receipt line</div>' * 50)
+
+
+def write_config():
+    config = ConfigParser()
+    config.read(os.path.join(ROOT, 'config', 'config.ini'))
+    config.set('application', 'print_status_start', 'false')
+    config.set('escpos_driver', 'mode', 'virtual')
+    config.set('escpos_driver', 'virtual_printers', '2')
+    config.set('escpos_driver', 'cashbox_printer', 'virtual-1')
+    fd, path = tempfile.mkstemp(prefix='pywebdriver-test-', suffix='.ini')
+    with os.fdopen(fd, 'w') as f:
+        config.write(f)
+    return path
+
+
+os.environ['PYWEBDRIVER_CONFIG'] = write_config()
+try:
+    from pywebdriver import drivers
+    from pywebdriver.plugins.escpos_driver import ESCPOSPool
+finally:
+    os.unlink(os.environ.pop('PYWEBDRIVER_CONFIG'))
+
+
+# Pools created by the tests
+pools = []
+
+
+def use_pool(pool):
+    """ The statuses of the printers are set by the tests: no refresh """
+    for printer in pool.printers.values():
+        printer.status_interval = None
+    pools.append(pool)
+    return pool
+
+
+def make_pool():
+    return use_pool(ESCPOSPool(virtual_printers=2))
+
+
+def tearDownModule():
+    """ Let the printer threads finish their jobs: a python 2 thread still
+    running at exit aborts the process """
+    for pool in pools:
+        for printer in pool.printers.values():
+            while printer.get_load():
+                time.sleep(0.05)
+
+
+def set_status(printer, status):
+    printer.status = {'status': status, 'messages': []}
+
+
+def queue_job(printer, task, data=None):
+    """ Queue a job without starting the worker of the printer """
+    job_id = int(time.time() * 1000000)
+    printer.jobs[job_id] = {
+        'job_id': job_id, 'task': task, 'state': 'queued', 'result': None,
+        'size': 0, 'estimate': 0.0}
+    printer.queue.put((time.time(), task, data, job_id, None))
+    return job_id
+
+
+class TestESCPOSPool(unittest.TestCase):
+
+    def test_cashbox_printer(self):
+        """ The drawer kicks and the status page go to the printer set by
+        cashbox_printer """
+        pool = use_pool(drivers['escpos'])
+        cashbox = pool.printers['virtual-1']
+        for task in ('open_cashbox', 'open_cashbox', 'printstatus'):
+            job_id = pool.push_task(task)
+            self.assertIn(job_id, cashbox.jobs)
+
+    def test_cashbox_first_printer(self):
+        """ Without cashbox_printer, the drawer is on the first printer """
+        pool = make_pool()
+        job_id = pool.push_task('open_cashbox')
+        self.assertIn(job_id, pool.printers['virtual-0'].jobs)
+
+    def test_receipts_balanced(self):
+        pool = make_pool()
+        for printer in pool.printers.values():
+            set_status(printer, 'connected')
+        job_ids = [pool.push_task('receipt', RECEIPT) for i in range(2)]
+        self.assertEqual(
+            [[job_id in printer.jobs for job_id in job_ids]
+             for printer in pool.printers.values()],
+            [[True, False], [False, True]])
+
+    def test_status_poll_keeps_jobs(self):
+        """ A printer whose status was never refreshed keeps its jobs """
+        pool = make_pool()
+        first, second = pool.printers.values()
+        set_status(second, 'connected')
+        job_id = queue_job(first, 'receipt', RECEIPT)
+        pool.get_status()
+        self.assertIn(job_id, first.jobs)
+
+    def test_failover(self):
+        """ The receipts of a printer in error go to the other printer, the
+        drawer kicks stay on it """
+        pool = make_pool()
+        first, second = pool.printers.values()
+        set_status(first, 'error')
+        set_status(second, 'connected')
+        receipt_id = queue_job(first, 'receipt', RECEIPT)
+        cashbox_id = queue_job(first, 'open_cashbox')
+        pool.failover(first)
+        self.assertIn(receipt_id, second.jobs)
+        self.assertNotIn(receipt_id, first.jobs)
+        self.assertIn(cashbox_id, first.jobs)
+
+
+if __name__ == '__main__':
+    unittest.main()